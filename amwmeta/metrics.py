@@ -0,0 +1,58 @@
+# process wide counters, rendered in the Prometheus text format
+import threading
+
+class Metrics:
+    def __init__(self, namespace="amw"):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._help = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=None):
+        """Add to the name_seconds_sum and name_seconds_count counters"""
+        self.inc(name + '_seconds_sum', labels, seconds)
+        self.inc(name + '_seconds_count', labels)
+
+    def values(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def render(self, extra=None):
+        """extra is a dict of name => value of counters kept elsewhere"""
+        lines = []
+        seen = set()
+        counters = self.values()
+        for name, labels in sorted(counters):
+            metric = self.namespace + '_' + name
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append("# HELP {0} {1}".format(metric, self._help[name]))
+                lines.append("# TYPE {0} counter".format(metric))
+            label_string = ''
+            if labels:
+                label_string = '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                                              for k, v in labels) + '}'
+            lines.append("{0}{1} {2}".format(metric, label_string, counters[(name, labels)]))
+        for name in sorted(extra or {}):
+            metric = self.namespace + '_' + name
+            lines.append("# TYPE {0} counter".format(metric))
+            lines.append("{0} {1}".format(metric, extra[name]))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe('search_requests_total', "Search requests")
+METRICS.describe('search_slow_total', "Search requests slower than the slow query threshold")
+METRICS.describe('search_phase_seconds_sum', "Seconds spent in each phase of the search requests")
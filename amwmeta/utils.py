@@ -1,6 +1,7 @@
 # port of https://metacpan.org/pod/Data::Page
 from dataclasses import dataclass
 from urllib.parse import urlencode
+import time
 
 @dataclass
 class DataPage:
@@ -47,7 +48,13 @@ class DataPage:
             return None
 
 
-def paginator(pager, base_url, params):
+# pages shown on each side of the current one
+PAGER_WINDOW = 2
+
+def paginator(pager, base_url, params, max_page=None):
+    """Links to the previous and next page, the first and the last page
+    and the PAGER_WINDOW pages around the current one. Pages after
+    max_page are not linked."""
     out = []
     common = []
     for param in params:
@@ -56,9 +63,13 @@ def paginator(pager, base_url, params):
                 common.append((param, value))
 
     # nothing to show
-    if pager.last_page() == 1:
+    if pager is None or pager.last_page() == 1:
         return None
 
+    last_page = pager.last_page()
+    if max_page is not None and max_page < last_page:
+        last_page = max_page
+
     if pager.previous_page():
         out.append({
             "label": "Previous",
@@ -67,16 +78,27 @@ def paginator(pager, base_url, params):
             "class": "page-link page-link-previous"
         })
 
-    for num in range(pager.first_page(), pager.last_page() + 1):
-        struct = {
+    window_start = max(pager.first_page(), pager.current_page - PAGER_WINDOW)
+    window_end = min(last_page, pager.current_page + PAGER_WINDOW)
+    pages = [ pager.first_page() ] + list(range(window_start, window_end + 1)) + [ last_page ]
+    previous = None
+    for num in sorted(set(pages)):
+        if previous is not None and num > previous + 1:
+            out.append({
+                "label": "…",
+                "current": False,
+                "url": None,
+                "class": "page-link page-link-gap"
+            })
+        out.append({
             "label": num,
             "current": pager.current_page == num,
             "url": get_paged_url(base_url, common, num),
             "class": "page-link page-link-" + str(num)
-        }
-        out.append(struct)
+        })
+        previous = num
 
-    if pager.next_page():
+    if pager.next_page() and pager.next_page() <= last_page:
         out.append({
             "label": "Next",
             "current": False,
@@ -86,7 +108,49 @@ def paginator(pager, base_url, params):
 
     return out
 
+def get_url_with(base_url, params, replace):
+    """Url of the current search with the replace params changed (or
+    removed, if None), back to the first page"""
+    query = []
+    for param in params:
+        if param != "page_number" and param not in replace:
+            for value in params.getlist(param):
+                query.append((param, value))
+    for param in replace:
+        if replace[param] is not None:
+            query.append((param, replace[param]))
+    return base_url + '?' + urlencode(query)
+
 def get_paged_url(base_url, common, num):
     query = common.copy()
     query.append(("page_number", num))
     return base_url + '?' + urlencode(query)
+
+
+class Timings:
+    """Elapsed seconds of the phases of a request.
+
+    mark(phase) closes the phase started at the previous mark (or at
+    the creation of the object).
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def total(self):
+        return self.last - self.started
+
+    def server_timing(self):
+        """Value of the Server-Timing header"""
+        out = [ "{0};dur={1:.2f}".format(phase, self.phases[phase] * 1000) for phase in self.phases ]
+        out.append("total;dur={0:.2f}".format(self.total() * 1000))
+        return ', '.join(out)
+
+    def __repr__(self):
+        return ' '.join("{0}={1:.4f}".format(phase, self.phases[phase]) for phase in self.phases)
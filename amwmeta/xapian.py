@@ -1,18 +1,42 @@
+import functools
 import json
+import re
 import sys
+import unicodedata
 import xapian
-from sickle import Sickle
+from sickle import Sickle, oaiexceptions
 from sickle.oaiexceptions import *
+from sickle.iterator import OAIItemIterator
+from sickle.response import OAIResponse, XMLParser
 from urllib.parse import urlparse
 from pathlib import Path
 import logging
-from amwmeta.utils import DataPage
-from sickle.models import Record
-import re
+from amwmeta.utils import DataPage, Timings
+from sickle.models import Record, Header, OAIItem
+from lxml import etree
+import os
+import shutil
+import threading
+import time
+import hashlib
+import heapq
+import queue
+import random
+import requests
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 
 logger = logging.getLogger(__name__)
 
 XAPIAN_DB = str(Path(__file__).resolve().parent.parent.joinpath('xapian', 'db'))
+# With one shard per site, each one lives in XAPIAN_SHARDS_DIR and
+# XAPIAN_STUB is the stub database listing them, opened as one.
+XAPIAN_SHARDS_DIR = str(Path(__file__).resolve().parent.parent.joinpath('xapian', 'shards'))
+XAPIAN_STUB = str(Path(__file__).resolve().parent.parent.joinpath('xapian', 'shards.stub'))
+# The suggestions of the shards together, see build_shard_suggestions
+XAPIAN_SUGGEST_DB = str(Path(__file__).resolve().parent.parent.joinpath('xapian', 'suggest'))
 
 # slot, prefix, boolean
 FIELD_MAPPING = {
@@ -24,35 +48,817 @@ FIELD_MAPPING = {
         'hostname': (6, 'H',  True),
 }
 
-def search(query_params):
-    db = xapian.Database(XAPIAN_DB)
-    querystring = query_params.get("query")
+# sortable values: the earliest year of the dates and the title
+# collation key
+DATE_SORT_SLOT = 7
+TITLE_SORT_SLOT = 8
+# title sort key of the untitled documents: the largest code point, so
+# they sort after every title
+TITLE_SORT_MISSING = '\U0010ffff'
 
-    # todo setup validation in the views.py
-    page_size = int(query_params.get("page_size", 10))
-    if page_size < 1:
-        page_size = 10
+# Copies of the same text harvested from different sites share the
+# value of this slot (the key of their cluster), so search() can
+# collapse them. The fingerprint of title, creator and language is
+# indexed with FINGERPRINT_PREFIX, the identifiers and urls with
+# IDENTIFIER_PREFIX and the cluster key with CLUSTER_PREFIX.
+CLUSTER_SLOT = 9
+FINGERPRINT_PREFIX = 'XF'
+IDENTIFIER_PREFIX = 'XI'
+CLUSTER_PREFIX = 'XD'
+# Copies listed as "also available at" for each collapsed match
+MAX_OTHER_COPIES = 10
 
-    page_number = int(query_params.get("page_number", 1))
-    if page_number < 1:
-        page_number = 1
+# Whole values indexed for the suggestions, as prefix + collation key
+# + FACET_SEPARATOR + value, so the term list sorted by prefix works as
+# a trie and the term frequency is the number of documents.
+SUGGEST_FIELDS = {
+    'title': 'XST',
+    'creator': 'XSA',
+    'subject': 'XSK',
+}
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+# The SUGGEST_MAX_LIMIT suggestions of the prefixes up to this length,
+# and of the longer ones with more than SUGGEST_MAX_SCAN terms, are
+# computed at the end of the harvest and stored in the metadata. The
+# others are looked up in the term list, which has few enough terms to
+# examine all of them.
+SUGGEST_PRECOMPUTED = 3
+SUGGEST_MAX_SCAN = 5000
+
+# sort mode: slot, descending
+SORT_MODES = {
+    'date': (DATE_SORT_SLOT, True),
+    'title': (TITLE_SORT_SLOT, False),
+}
+
+# Fields of the record kept in the document data, for display
+STORED_FIELDS = [ 'title', 'creator', 'language', 'description' ]
+
+# fields of a StoredRecord
+RECORD_FIELDS = [ 'oai_pmh_identifier', 'title', 'creator', 'language', 'description', 'url', 'identifiers',
+                  'also_available' ]
+
+# Version of the index layout, stored in the database metadata.
+#  1: the value slots hold a JSON list
+#  2: the value slots hold the sorted values joined by FACET_SEPARATOR
+#  3: DATE_SORT_SLOT and TITLE_SORT_SLOT
+#  4: CLUSTER_SLOT and the deduplication terms
+#  5: the SUGGEST_FIELDS terms
+#  6: languages, fingerprint and cluster from the normalized languages
+#  7: TITLE_SORT_MISSING in TITLE_SORT_SLOT for the untitled documents
+#  8: no fingerprint for the records without creators
+SCHEMA_VERSION = 8
+FACET_SEPARATOR = '\x1f'
+
+# Maximum number of documents the match spies examine for the facets of
+# a free text or filtered query. None or 0 means all of them.
+FACET_SAMPLE_SIZE = None
+
+# Values shown for each facet, the most common first. The others are
+# counted, and can be paged with facet_values(). None shows all.
+FACET_LIMIT = 20
+FACET_PAGE_SIZE = 50
+# Values shown for the facets listed in the "expand" parameter
+FACET_EXPANDED_LIMIT = 200
+
+# Deepest offset reachable by page number. Further results are
+# reachable only with a cursor (the "after" parameter).
+SEARCH_MAX_OFFSET = 10000
+# Largest page, by page number or by cursor
+SEARCH_MAX_PAGE_SIZE = 100
+# Matches fetched at once while skipping the ties of a cursor
+CURSOR_CHUNK_SIZE = 100
+# Matches fetched at once by export_records
+EXPORT_CHUNK_SIZE = 500
+
+# The harvest commits every HARVEST_COMMIT_EVERY documents or every
+# HARVEST_COMMIT_INTERVAL seconds, whatever comes first.
+HARVEST_COMMIT_EVERY = 1000
+HARVEST_COMMIT_INTERVAL = 60
+
+# Records taking longer than this (in seconds) to parse are logged
+HARVEST_SLOW_PARSE = 0.5
+
+# Concurrent fetches from the same host during a multi-site harvest
+HARVEST_PER_HOST = 2
+
+# Documents built by the harvesting threads and waiting for the writer
+HARVEST_QUEUE_SIZE = 500
+
+# HTTP settings of the harvest: timeout in seconds, connections kept
+# alive per host, retries on errors and 5xx responses with an
+# exponential backoff starting at HARVEST_RETRY_BACKOFF seconds, unless
+# the server sends a Retry-After (capped to HARVEST_MAX_RETRY_AFTER)
+HARVEST_TIMEOUT = 60
+HARVEST_HTTP_POOL = 8
+HARVEST_MAX_RETRIES = 5
+HARVEST_RETRY_BACKOFF = 2
+HARVEST_MAX_RETRY_AFTER = 120
+
+# Only the last log lines (and errors) of a harvest are kept
+HARVEST_LOG_LINES = 50
+
+def encode_facet_values(values):
+    # sorted and deduplicated, so the same set of values always ends
+    # up in the same spy bucket
+    cleaned = set(v.replace(FACET_SEPARATOR, ' ') for v in values)
+    return FACET_SEPARATOR.join(sorted(cleaned))
+
+def decode_facet_values(value, schema_version=SCHEMA_VERSION):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if not value:
+        return []
+    if schema_version < 2:
+        return json.loads(value)
+    return value.split(FACET_SEPARATOR)
+
+def get_schema_version(db):
+    version = db.get_metadata('schema_version')
+    if version:
+        return int(version)
+    # databases created before the marker was introduced
+    return 1
+
+def stored_record(record, identifier):
+    """The compact record stored in the document data: only the
+    displayed fields, with the url picked among the identifiers"""
+    rec = { "oai_pmh_identifier": identifier }
+    for field in STORED_FIELDS:
+        values = record.get(field)
+        if values:
+            rec[field] = values
+    identifiers = record.get('identifier')
+    if identifiers:
+        urls = [ i for i in identifiers if i.startswith(('http://', 'https://')) ]
+        if len(urls):
+            rec['url'] = urls[0]
+            rec['identifiers'] = identifiers
+    return rec
+
+
+class StoredRecord:
+    """Document data, decoded only when a field is first accessed"""
+    def __init__(self, data):
+        self._data = data
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            fields = json.loads(self._data)
+            # the whole OAI record, as stored by older harvests
+            if 'identifier' in fields:
+                fields = stored_record(fields, fields.get('oai_pmh_identifier'))
+            self._fields = fields
+        return self._fields
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def get(self, field, default=None):
+        return self.fields.get(field, default)
+
+    def keys(self):
+        return self.fields.keys()
+
+    def __repr__(self):
+        return '<StoredRecord {0}>'.format(self.get('oai_pmh_identifier'))
+
+
+YEAR_RE = re.compile(r'(?<!\d)(1\d{3}|20\d{2})(?!\d)')
+
+def normalize_year(values):
+    """The earliest year found in the free form dates, or None"""
+    years = [ int(year) for value in values or [] for year in YEAR_RE.findall(value) ]
+    if years:
+        return min(years)
+    return None
+
+def title_sort_key(title):
+    """Lowercase words of the title, without accents and punctuation"""
+    decomposed = unicodedata.normalize('NFKD', title)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'\w+', stripped.casefold()))
 
+def record_fingerprint(titles, creators, languages):
+    """Hash of the normalized title, creators and languages, or None
+    without a title or a creator: different anonymous texts often share
+    a title (Poems, Manifesto), so they are clustered only by a shared
+    identifier"""
+    if not titles:
+        return None
+    creator_keys = sorted(key for key in (title_sort_key(c) for c in creators or []) if key)
+    if not creator_keys:
+        return None
+    parts = [ title_sort_key(titles[0]),
+              '|'.join(creator_keys),
+              '|'.join(sorted(languages or [])) ]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+def identifier_key(identifier):
+    """Identifier or url without scheme, trailing slash and case"""
+    key = identifier.strip().lower()
+    for scheme in ('https://', 'http://'):
+        if key.startswith(scheme):
+            key = key[len(scheme):]
+            break
+    # terms are limited to 245 bytes
+    return key.rstrip('/')[:200]
+
+def add_dedup_terms(doc, fingerprint, identifiers):
+    """Index the fingerprint and the identifiers of a record. The
+    cluster is assigned by the writer (see assign_cluster)."""
+    if fingerprint is not None:
+        doc.add_boolean_term(FINGERPRINT_PREFIX + fingerprint)
+    for identifier in identifiers or []:
+        key = identifier_key(identifier)
+        if key:
+            doc.add_boolean_term(IDENTIFIER_PREFIX + key)
+
+def assign_cluster(db, idterm, doc):
+    """Set the cluster of a document about to be written: the cluster of
+    another document with the same fingerprint or a shared identifier,
+    else a new one keyed by its own fingerprint (or identifier).
+
+    Only the posting lists of the document's own terms are read, so
+    this doesn't depend on the size of the index.
+    """
+    fingerprint = None
+    lookup = []
+    for item in doc.termlist():
+        term = item.term.decode('utf-8')
+        if term.startswith(FINGERPRINT_PREFIX):
+            fingerprint = term[len(FINGERPRINT_PREFIX):]
+            lookup.insert(0, term)
+        elif term.startswith(IDENTIFIER_PREFIX):
+            lookup.append(term)
+    # the previous version of the document itself, if any
+    own = set(posting.docid for posting in db.postlist(idterm))
+    key = None
+    for term in lookup:
+        for posting in db.postlist(term):
+            if posting.docid not in own:
+                key = db.get_document(posting.docid).get_value(CLUSTER_SLOT).decode('utf-8')
+                if key:
+                    break
+                key = None
+        if key is not None:
+            break
+    if key is None:
+        key = fingerprint or hashlib.sha1(idterm.encode('utf-8')).hexdigest()[:16]
+    doc.add_value(CLUSTER_SLOT, key)
+    doc.add_boolean_term(CLUSTER_PREFIX + key)
+
+def refresh_languages(db, doc):
+    """Index the languages of the stored record again, with the
+    fingerprint and the cluster which depend on them"""
+    slot, prefix, is_boolean = FIELD_MAPPING['language']
+    record = StoredRecord(doc.get_data())
+    languages = normalize_languages(record.get('language'))
+    for item in list(doc.termlist()):
+        term = item.term.decode('utf-8')
+        if term.startswith((prefix, FINGERPRINT_PREFIX, CLUSTER_PREFIX)):
+            doc.remove_term(term)
+    if doc.get_value(slot):
+        doc.remove_value(slot)
+    if languages:
+        for code in languages:
+            doc.add_boolean_term(prefix + code.lower())
+        doc.add_value(slot, encode_facet_values(languages))
+    add_dedup_terms(doc, record_fingerprint(record.get('title'), record.get('creator'), languages), [])
+    assign_cluster(db, 'Q' + record.get('oai_pmh_identifier', ''), doc)
+
+def other_copies(db, match):
+    """Urls of the other documents of the cluster of a collapsed match"""
+    key = match.document.get_value(CLUSTER_SLOT).decode('utf-8')
+    out = []
+    for posting in db.postlist(CLUSTER_PREFIX + key):
+        if posting.docid == match.docid:
+            continue
+        other = StoredRecord(db.get_document(posting.docid).get_data())
+        url = other.get('url')
+        if url:
+            out.append({ "url": url, "host": urlparse(url).hostname })
+        if len(out) >= MAX_OTHER_COPIES:
+            break
+    return out
+
+def suggest_term(prefix, value):
+    key = title_sort_key(value)
+    if not key:
+        return None
+    term = prefix + key[:100] + FACET_SEPARATOR + ' '.join(value.split())
+    # terms are limited to 245 bytes
+    return term.encode('utf-8')[:240].decode('utf-8', 'ignore')
+
+def add_suggest_terms(doc, record):
+    for field in SUGGEST_FIELDS:
+        for value in record.get(field) or []:
+            term = suggest_term(SUGGEST_FIELDS[field], value)
+            if term:
+                doc.add_boolean_term(term)
+
+def suggestion_counts(db, prefix, start='', max_scan=None):
+    """collation key => [ documents, value, documents of the value,
+    terms ] of the suggestion terms of prefix with a key starting with
+    start. The counts of the spellings of the same key are summed, the
+    most common one is shown."""
+    counts = {}
+    for n, item in enumerate(db.allterms(prefix + start)):
+        if max_scan and n >= max_scan:
+            break
+        key, _, value = item.term.decode('utf-8')[len(prefix):].partition(FACET_SEPARATOR)
+        entry = counts.get(key)
+        if entry is None:
+            counts[key] = [ item.termfreq, value, item.termfreq, 1 ]
+        else:
+            entry[0] += item.termfreq
+            entry[3] += 1
+            if item.termfreq > entry[2]:
+                entry[1] = value
+                entry[2] = item.termfreq
+    return counts
+
+def prefix_suggestions(db, prefix, start, lengths, limit):
+    """prefix of one of the lengths => heap of the limit most common
+    (documents, value) of the keys starting with start, and the number
+    of suggestion terms under each prefix"""
+    top = {}
+    terms = {}
+    counts = suggestion_counts(db, prefix, start)
+    for key in counts:
+        entry = (counts[key][0], counts[key][1])
+        for length in lengths:
+            if len(key) < length:
+                break
+            heap = top.setdefault(key[:length], [])
+            terms[key[:length]] = terms.get(key[:length], 0) + counts[key][3]
+            if len(heap) < limit:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+    return top, terms
+
+def build_suggestions(db, target=None, limit=SUGGEST_MAX_LIMIT):
+    """Store the top suggestions of every prefix up to
+    SUGGEST_PRECOMPUTED characters in the metadata of target (db by
+    default), then one more character at a time for the prefixes with
+    more than SUGGEST_MAX_SCAN terms. One pass over the suggestion
+    terms, plus one over the terms of each of these prefixes, the
+    documents are not read."""
+    if target is None:
+        target = db
+    for field in SUGGEST_FIELDS:
+        stale = set(k.decode('utf-8') for k in target.metadata_keys('suggest:' + field + ':'))
+        pending = [ ('', list(range(1, SUGGEST_PRECOMPUTED + 1))) ]
+        while pending:
+            start, lengths = pending.pop()
+            top, terms = prefix_suggestions(db, SUGGEST_FIELDS[field], start, lengths, limit)
+            for prefix in top:
+                metadata_key = 'suggest:' + field + ':' + prefix
+                stale.discard(metadata_key)
+                suggestions = [ { "value": value, "count": count }
+                                for count, value in sorted(top[prefix], key=lambda el: (0 - el[0], el[1])) ]
+                target.set_metadata(metadata_key, json.dumps(suggestions, separators=(',', ':')))
+                # metadata keys are limited to 245 bytes
+                if len(prefix) == lengths[-1] and terms[prefix] > SUGGEST_MAX_SCAN \
+                   and len(metadata_key.encode('utf-8')) < 200:
+                    pending.append((prefix, [ len(prefix) + 1 ]))
+        for metadata_key in stale:
+            target.set_metadata(metadata_key, '')
+    target.set_metadata('suggest_limit', str(limit))
+
+def build_shard_suggestions(stub=XAPIAN_STUB, path=XAPIAN_SUGGEST_DB):
+    """Store the suggestions of the shards listed in the stub, searched
+    together, in the metadata of the database at path"""
+    target = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+    try:
+        # without shards, everything stored is stale
+        db = xapian.Database(stub) if stub_paths(stub) else xapian.Database()
+        try:
+            build_suggestions(db, target)
+        finally:
+            db.close()
+        target.commit()
+    finally:
+        target.close()
+
+def suggest(field, text, limit=SUGGEST_LIMIT, readers=None, precomputed=None):
+    """The most common values of the field starting with text.
+
+    The stored suggestions are read from the database of the
+    precomputed pool if given (see build_shard_suggestions), else
+    from the one of readers."""
+    if field not in SUGGEST_FIELDS:
+        return []
+    key = title_sort_key(text or '')
+    if not key:
+        return []
+    if readers is None:
+        readers = READERS
+    db, queryparser = readers.get()
+    source = db
+    if precomputed is not None:
+        try:
+            source, source_queryparser = precomputed.get()
+        except xapian.DatabaseOpeningError:
+            # not built yet
+            source = None
+    elif readers.sharded:
+        # the metadata of a combined database is the one of the first shard
+        source = None
+    # indexes built when fewer suggestions were stored
+    if source is not None and limit <= parse_integer(source.get_metadata('suggest_limit'), SUGGEST_LIMIT):
+        stored = source.get_metadata('suggest:' + field + ':' + key)
+        if stored:
+            return json.loads(stored)[:limit]
+    counts = suggestion_counts(db, SUGGEST_FIELDS[field], key, SUGGEST_MAX_SCAN)
+    top = heapq.nsmallest(limit, counts.values(), key=lambda entry: (0 - entry[0], entry[1]))
+    return [ { "value": entry[1], "count": entry[0] } for entry in top ]
+
+def match_record(db, match):
+    """StoredRecord of a match, with the other copies of a collapsed one"""
+    record = StoredRecord(match.document.get_data())
+    if match.collapse_count:
+        record.fields['also_available'] = other_copies(db, match)
+    return record
+
+def add_sort_values(doc, titles, dates):
+    year = normalize_year(dates)
+    if year is not None:
+        doc.add_value(DATE_SORT_SLOT, xapian.sortable_serialise(year))
+    key = title_sort_key(titles[0]) if titles else ''
+    doc.add_value(TITLE_SORT_SLOT, key or TITLE_SORT_MISSING)
+
+def parse_year(value):
+    return parse_integer(value, None)
+
+def parse_integer(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def year_range_query(date_from, date_to):
+    if date_from is not None and date_to is not None:
+        return xapian.Query(xapian.Query.OP_VALUE_RANGE, DATE_SORT_SLOT,
+                            xapian.sortable_serialise(date_from),
+                            xapian.sortable_serialise(date_to))
+    elif date_from is not None:
+        return xapian.Query(xapian.Query.OP_VALUE_GE, DATE_SORT_SLOT,
+                            xapian.sortable_serialise(date_from))
+    elif date_to is not None:
+        return xapian.Query(xapian.Query.OP_VALUE_LE, DATE_SORT_SLOT,
+                            xapian.sortable_serialise(date_to))
+    return None
+
+def date_histogram(years, date_from=None, date_to=None):
+    """Bucket the year => count dict by decade, or by year when the
+    selected range fits in a decade"""
+    width = 10
+    granularity = 'decade'
+    if date_from is not None and date_to is not None and date_to - date_from < 10:
+        width = 1
+        granularity = 'year'
+    buckets = {}
+    for year in years:
+        start = year - year % width
+        buckets[start] = buckets.get(start, 0) + years[year]
+    out = []
+    for start in sorted(buckets):
+        end = start + width - 1
+        out.append({
+            "label": str(start) if width == 1 else str(start) + 's',
+            "from": start,
+            "to": end,
+            "count": buckets[start],
+            "active": date_from == start and date_to == end,
+        })
+    return {
+        "granularity": granularity,
+        "buckets": out,
+    }
+
+# year:1900..1950 in the query string, shared by the parsers
+YEAR_RANGE_PROCESSOR = xapian.NumberRangeProcessor(DATE_SORT_SLOT, 'year:')
+
+def build_queryparser(db=None):
     queryparser = xapian.QueryParser()
     queryparser.set_stemmer(xapian.Stem("none"))
     queryparser.set_stemming_strategy(queryparser.STEM_NONE)
+    queryparser.set_default_op(xapian.Query.OP_AND)
+    if db is not None:
+        queryparser.set_database(db)
 
     for field in FIELD_MAPPING:
         if FIELD_MAPPING[field][2]:
             queryparser.add_boolean_prefix(field, FIELD_MAPPING[field][1])
         else:
             queryparser.add_prefix(field, FIELD_MAPPING[field][1])
+    queryparser.add_rangeprocessor(YEAR_RANGE_PROCESSOR)
+    return queryparser
 
-    context = {}
-    spies = {}
-    if querystring:
-        context['querystring'] = querystring
+
+def stub_paths(stub):
+    """The local databases listed in a stub database file"""
+    base = os.path.dirname(stub)
+    paths = []
+    with open(stub) as fh:
+        for line in fh:
+            parts = line.split(None, 1)
+            if len(parts) == 2 and parts[0] in ('auto', 'glass', 'chert'):
+                paths.append(os.path.join(base, parts[1].strip()))
+    return paths
+
+def write_stub(paths, stub=XAPIAN_STUB):
+    """Atomically replace the stub database with the list of paths"""
+    tmp_stub = stub + '.tmp'
+    with open(tmp_stub, 'w') as fh:
+        for path in paths:
+            fh.write('auto ' + os.path.abspath(path) + '\n')
+    os.replace(tmp_stub, stub)
+
+
+class ReaderPool:
+    """Keep one open database and query parser per thread.
+
+    The database is reopened only when the version file on disk has
+    been touched by a commit, otherwise the cached handle is returned
+    as is. When the path is a symlink swapped to a new generation (see
+    swap_index), the database is opened again from scratch.
+
+    The path can also be a stub file listing several databases (the
+    shards), searched together. The generation is then the list of
+    their directories, so adding, dropping or swapping a shard opens
+    the combined database again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = { "hits": 0, "reopens": 0, "opens": 0 }
+
+    def _count(self, what):
+        with self._lock:
+            self._stats[what] += 1
+
+    @property
+    def sharded(self):
+        return os.path.isfile(self.path)
+
+    def stamp(self):
+        if self.sharded:
+            directories = [ os.path.realpath(path) for path in stub_paths(self.path) ]
+            generation = tuple(directories)
+        else:
+            generation = os.path.realpath(self.path)
+            directories = [ generation ]
+        # glass (iamglass) and chert (iamchert) replace the version
+        # file by a rename on every commit. Two commits can share the
+        # modification time, but not the inode.
+        mtimes = []
+        files = []
+        for directory in directories:
+            for version_file in sorted(Path(directory).glob('iam*')):
+                try:
+                    st = version_file.stat()
+                except FileNotFoundError:
+                    continue
+                mtimes.append(st.st_mtime_ns)
+                files.append((st.st_ino, st.st_size))
+        if mtimes:
+            # the latest commit first, so the stamps still grow with time
+            return generation, (max(mtimes), tuple(files))
+        return generation, None
+
+    def get(self):
+        local = self._local
+        generation, stamp = self.stamp()
+        db = getattr(local, 'db', None)
+        if db is not None and generation != local.generation:
+            db.close()
+            db = None
+        if db is None:
+            db = xapian.Database(self.path if self.sharded else generation)
+            local.db = db
+            local.queryparser = build_queryparser(db)
+            self._count("opens")
+        elif stamp != local.stamp:
+            db.reopen()
+            self._count("reopens")
+        else:
+            self._count("hits")
+        local.generation = generation
+        local.stamp = stamp
+        return local.db, local.queryparser
+
+    def revision(self):
+        """Generation and revision of the thread's database"""
+        local = self._local
+        try:
+            return local.generation, local.db.get_revision()
+        except xapian.InvalidOperationError:
+            # a combined database has no revision of its own: the
+            # last commit time of the shards is as good
+            return local.generation, local.stamp
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+READERS = ReaderPool(XAPIAN_DB)
+
+
+class FacetCache:
+    """Facet counts of the queries without free text, per revision.
+
+    Revisions are (generation, revision number) as returned by
+    ReaderPool.revision().
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.revision = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, revision, key):
+        with self._lock:
+            if revision != self.revision:
+                return None
+            return self._entries.get(key)
+
+    def set(self, revision, key, counts):
+        with self._lock:
+            # a thread still reading an older revision. Only plain
+            # revision numbers are ordered: the stamps of the sharded
+            # indexes, or a missing one, just replace the cache.
+            if self.revision is not None and revision[0] == self.revision[0] \
+               and type(revision[1]) is int and type(self.revision[1]) is int \
+               and revision[1] < self.revision[1]:
+                return
+            if revision != self.revision or len(self._entries) >= self.max_entries:
+                self._entries = {}
+                self.revision = revision
+            self._entries[key] = counts
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.revision = None
+
+
+FACET_COUNTS = FacetCache()
+
+def reader_stats():
+    return READERS.stats()
+
+def search_cache_key(query_params, revision, page_number, page_size, facet_sample_size,
+                     sort=None, date_from=None, date_to=None, after=None, facet_limit=None,
+                     collapse=True):
+    querystring = ' '.join((query_params.get("query") or '').split())
+    filters = []
+    for field in FIELD_MAPPING:
+        if FIELD_MAPPING[field][2]:
+            values = set(v for v in query_params.getlist('filter_' + field) if v)
+            filters.append([ field, sorted(values) ])
+    expand = sorted(set(query_params.getlist('expand')))
+    key = json.dumps([ list(revision), querystring, filters, page_number, page_size, facet_sample_size,
+                       sort, date_from, date_to, after, facet_limit, expand, collapse ])
+    return 'search:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def encode_cursor(sort, match):
+    """Position of the match in a value sort: the value of the sort slot
+    and the docid, which breaks the ties"""
+    value = match.document.get_value(SORT_MODES[sort][0])
+    return "{0}-{1}".format(match.docid, value.hex())
+
+def decode_cursor(cursor):
+    """(value, docid) of a cursor, or None if it's invalid"""
+    try:
+        docid, value = cursor.split('-', 1)
+        return (bytes.fromhex(value), int(docid))
+    except (AttributeError, ValueError):
+        return None
+
+def empty_value_query(slot):
+    """The documents without a value in the slot"""
+    return xapian.Query(xapian.Query.OP_AND_NOT, xapian.Query.MatchAll,
+                        xapian.Query(xapian.Query.OP_VALUE_GE, slot, '\x00'))
+
+def search_after(db, enquire, query, sort, after, page_size):
+    """Matches following the cursor, and the cursor of the next page.
+
+    The query is restricted to the values from the cursor onwards, so
+    the cost doesn't grow with the depth. Only the ties of the cursor
+    value are skipped, a chunk at a time.
+
+    Documents without a value sort first in ascending order and last in
+    descending order, and value ranges never match them, so they are
+    added back explicitly. The untitled documents have the
+    TITLE_SORT_MISSING value instead, which is paged like any other.
+    """
+    slot, descending = SORT_MODES[sort]
+    # docid ascending is the default order of the ties
+    enquire.set_sort_by_value(slot, descending)
+    position = decode_cursor(after) if after else None
+    if position is not None:
+        value, docid = position
+        restrict = None
+        if value:
+            op = xapian.Query.OP_VALUE_LE if descending else xapian.Query.OP_VALUE_GE
+            restrict = xapian.Query(op, slot, value)
+            if descending:
+                restrict = xapian.Query(xapian.Query.OP_OR, restrict, empty_value_query(slot))
+        elif descending:
+            # only the documents without a value are left
+            restrict = empty_value_query(slot)
+        # else everything follows the documents without a value
+        if restrict is not None:
+            query = xapian.Query(xapian.Query.OP_FILTER, query, restrict)
+    enquire.set_query(query)
+    matches = []
+    last = None
+    more = False
+    start = 0
+    while True:
+        mset = enquire.get_mset(start, CURSOR_CHUNK_SIZE)
+        for match in mset:
+            if position is not None and (match.document.get_value(slot) == value
+                                         and match.docid <= docid):
+                continue
+            if len(matches) == page_size:
+                more = True
+                break
+            matches.append(match_record(db, match))
+            last = match
+        if more or mset.size() < CURSOR_CHUNK_SIZE:
+            break
+        start += CURSOR_CHUNK_SIZE
+    next_cursor = None
+    if more:
+        next_cursor = encode_cursor(sort, last)
+    return matches, next_cursor
+
+
+class ResultCache:
+    """In-process LRU cache with a time to live, for search() results.
+
+    Any object with the same get(key) and set(key, value) methods can
+    be passed to search() instead.
+    """
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def build_query(queryparser, querystring, query_params, date_from=None, date_to=None):
+    """The query of the search parameters, with the active filters.
+
+    Return the query, the active filter values by field and the list of
+    filter queries.
+    """
     query = xapian.Query.MatchAll
-    queryparser.set_default_op(xapian.Query.OP_AND)
     if querystring:
         logger.info("Query is " + querystring)
         flags = queryparser.FLAG_PHRASE | queryparser.FLAG_BOOLEAN  | queryparser.FLAG_LOVEHATE | queryparser.FLAG_WILDCARD
@@ -68,391 +874,854 @@ def search(query_params):
             for value in query_params.getlist('filter_' + field):
                 if value:
                     filter_value = FIELD_MAPPING[field][1] + value.lower();
-                    logger.info("Filter value is " + filter_value)
+                    logger.debug("Filter value is " + filter_value)
                     filters_ors.append(xapian.Query(filter_value))
                     active_facets[field].append(value)
             if len(filters_ors):
                 filter_queries.append(xapian.Query(xapian.Query.OP_OR, filters_ors))
 
-    logger.info(filter_queries)
+    year_range = year_range_query(date_from, date_to)
+    if year_range is not None:
+        filter_queries.append(year_range)
+
+    logger.debug(filter_queries)
     if len(filter_queries):
         query = xapian.Query(xapian.Query.OP_FILTER, query,
                              xapian.Query(xapian.Query.OP_AND, filter_queries))
+    return query, active_facets, filter_queries
+
+def facet_cache_key(active_facets, date_from, date_to, collapse=True):
+    # the spies count the collapsed documents too, but the total doesn't
+    return tuple((field, tuple(sorted(v.lower() for v in active_facets[field])))
+                 for field in active_facets) + ((date_from, date_to, collapse),)
+
+def facet_sort_key(item):
+    return (0 - item[1], item[0])
+
+def top_facet_values(counts, active, limit=FACET_LIMIT):
+    """The limit most common values of a facet, plus the active ones, and
+    the number of values left out. Only the shown values are sorted."""
+    if limit and len(counts) > limit:
+        top = heapq.nsmallest(limit, counts.items(), key=facet_sort_key)
+        shown = set(value for value, count in top)
+        extra = [ (value, counts[value]) for value in active if value in counts and value not in shown ]
+        if extra:
+            top = sorted(top + extra, key=facet_sort_key)
+    else:
+        top = sorted(counts.items(), key=facet_sort_key)
+    values = [
+        {
+            "term": facet_value,
+            "count": count,
+            "active": facet_value in active,
+        } for facet_value, count in top
+    ]
+    return values, len(counts) - len(values)
+
+def search(query_params, facet_sample_size=FACET_SAMPLE_SIZE, cache=None, readers=None,
+           max_offset=SEARCH_MAX_OFFSET, collapse=True, facet_limit=FACET_LIMIT):
+    timings = Timings()
+    if readers is None:
+        readers = READERS
+    db, queryparser = readers.get()
+    timings.mark('open')
+    querystring = query_params.get("query")
+
+    # invalid numbers fall back to the defaults (the JSON API rejects
+    # them beforehand)
+    page_size = parse_integer(query_params.get("page_size"), 10)
+    if page_size < 1:
+        page_size = 10
+    page_size = min(page_size, SEARCH_MAX_PAGE_SIZE)
+
+    page_number = parse_integer(query_params.get("page_number"), 1)
+    if page_number < 1:
+        page_number = 1
+
+    sort = query_params.get("sort")
+    if sort not in SORT_MODES:
+        sort = "relevance"
+    date_from = parse_year(query_params.get("date_from"))
+    date_to = parse_year(query_params.get("date_to"))
+
+    # opt-in cursor mode, for the value sorts only. An empty "after"
+    # asks for the first page.
+    after = query_params.get("after")
+    if sort not in SORT_MODES:
+        after = None
+
+    if max_offset and (page_number - 1) * page_size >= max_offset:
+        page_number = max(1, max_offset // page_size)
+
+    # the revision is part of the key, so every commit invalidates
+    # the cached results
+    cache_key = None
+    if cache is not None:
+        cache_key = search_cache_key(query_params, readers.revision(),
+                                     page_number, page_size, facet_sample_size,
+                                     sort, date_from, date_to, after, facet_limit, collapse)
+        cached = cache.get(cache_key)
+        timings.mark('cache')
+        if cached is not None:
+            context = dict(cached)
+            context['cache_hit'] = True
+            context['timings'] = timings
+            return context
+
+    context = {}
+    if querystring:
+        context['querystring'] = querystring
+    query, active_facets, filter_queries = build_query(queryparser, querystring, query_params,
+                                                       date_from, date_to)
+    timings.mark('parse')
 
     enquire = xapian.Enquire(db)
+    if collapse:
+        enquire.set_collapse_key(CLUSTER_SLOT)
+    if after is not None:
+        # no facets nor pages: the query is restricted to what follows
+        # the cursor
+        matches, next_cursor = search_after(db, enquire, query, sort, after, page_size)
+        timings.mark('mset')
+        context['matches'] = matches
+        context['next_cursor'] = next_cursor
+        context['after'] = after
+        context['facets'] = []
+        context['date_histogram'] = None
+        context['facets_approximate'] = False
+        context['filters'] = active_facets
+        context['pager'] = None
+        context['max_page'] = None
+        context['querystring'] = querystring
+        context['sort'] = sort
+        context['sort_modes'] = [ 'relevance' ] + list(SORT_MODES)
+        context['date_from'] = date_from
+        context['date_to'] = date_to
+        if cache_key is not None:
+            cache.set(cache_key, context)
+            context = dict(context)
+        context['cache_hit'] = False
+        context['timings'] = timings
+        return context
+
     enquire.set_query(query)
+    if sort in SORT_MODES:
+        slot, descending = SORT_MODES[sort]
+        enquire.set_sort_by_value_then_relevance(slot, descending)
     matches = []
-    facets = []
-    for field in FIELD_MAPPING:
-        # boolean only
-        if FIELD_MAPPING[field][2]:
-            # use the slot
-            spy = xapian.ValueCountMatchSpy(FIELD_MAPPING[field][0])
-            enquire.add_matchspy(spy)
-            spies[field] = spy
+
+    # the facet counts of a query without free text depend only on the
+    # filters, so they can be computed once per index revision.
+    facet_key = None
+    facet_counts = None
+    if not querystring:
+        facet_key = facet_cache_key(active_facets, date_from, date_to, collapse)
+        facet_counts = FACET_COUNTS.get(readers.revision(), facet_key)
+
+    spies = {}
+    year_spy = None
+    check_at_least = 0
+    if facet_counts is None:
+        for field in FIELD_MAPPING:
+            # boolean only. The raw dates are counted by year instead,
+            # for the histogram
+            if FIELD_MAPPING[field][2] and field != 'date':
+                # use the slot
+                spy = xapian.ValueCountMatchSpy(FIELD_MAPPING[field][0])
+                enquire.add_matchspy(spy)
+                spies[field] = spy
+        year_spy = xapian.ValueCountMatchSpy(DATE_SORT_SLOT)
+        enquire.add_matchspy(year_spy)
+        check_at_least = db.get_doccount()
+        # the landing page is cached, so count it exhaustively
+        if facet_sample_size and (querystring or len(filter_queries)):
+            check_at_least = min(check_at_least, facet_sample_size)
 
     start = (page_number - 1) * page_size
-    mset = enquire.get_mset(start, page_size, db.get_doccount())
-    pager = DataPage(total_entries=mset.get_matches_estimated(),
+    mset = enquire.get_mset(start, page_size, check_at_least)
+    timings.mark('mset')
+    total_entries = mset.get_matches_estimated()
+    if facet_counts is not None and facet_counts['total'] is not None:
+        total_entries = facet_counts['total']
+    pager = DataPage(total_entries=total_entries,
                      entries_per_page=page_size,
                      current_page=page_number)
-    logger.info(pager)
+    logger.debug(pager)
 
     for match in mset:
-        fields = json.loads(match.document.get_data().decode('utf8'))
-        rec = {}
-        for field in fields:
-            values = fields.get(field)
-            if values:
-                if field == "identifier":
-                    urls = [ i for i in values if re.match(r'^https?://', i) ]
-                    if len(urls):
-                        rec['url'] = urls[0]
-                        rec['identifiers'] = values
-                else:
-                    rec[field] = values
-
-        logger.info(rec)
-        matches.append(rec)
-
-    for spy_name in spies:
-        spy = spies[spy_name]
-        facet_values = {}
-        for facet in spy.values():
-            # logger.info(facet.term)
-            for facet_value in json.loads(facet.term.decode('utf-8')):
-
-                facet_active = False
-                if facet_value in active_facets[spy_name]:
-                    facet_active = True
+        matches.append(match_record(db, match))
+    logger.debug("Returning {0} matches".format(len(matches)))
+    timings.mark('hydrate')
 
-                if facet_value in facet_values:
-                    facet_values[facet_value]['count'] += facet.termfreq
-                else:
-                    facet_values[facet_value] = {
-                        "term": facet_value,
-                        "count": facet.termfreq,
-                        "active": facet_active,
-                    }
+    if facet_counts is None:
+        facet_counts = {
+            "approximate": False,
+            "total": None,
+            "fields": {},
+        }
+        schema_version = get_schema_version(db)
+        for spy_name in spies:
+            spy = spies[spy_name]
+            # the spy saw only part of the matching documents
+            if spy.get_total() < mset.get_matches_upper_bound():
+                facet_counts['approximate'] = True
+            counts = {}
+            for facet in spy.values():
+                # logger.info(facet.term)
+                for facet_value in decode_facet_values(facet.term, schema_version):
+                    counts[facet_value] = counts.get(facet_value, 0) + facet.termfreq
+            facet_counts['fields'][spy_name] = counts
+        years = {}
+        for facet in year_spy.values():
+            year = int(xapian.sortable_unserialise(facet.term))
+            years[year] = years.get(year, 0) + facet.termfreq
+        facet_counts['years'] = years
+        if not facet_counts['approximate']:
+            facet_counts['total'] = mset.get_matches_estimated()
+        if facet_key is not None:
+            FACET_COUNTS.set(readers.revision(), facet_key, facet_counts)
 
-        if len(facet_values):
+    facets = []
+    expand = query_params.getlist('expand')
+    for field in facet_counts['fields']:
+        limit = facet_limit
+        if limit and field in expand:
+            limit = max(limit, FACET_EXPANDED_LIMIT)
+        values, more = top_facet_values(facet_counts['fields'][field], active_facets[field], limit)
+        if len(values):
             facets.append({
-                "name": spy_name,
-                "values": sorted(list(facet_values.values()), key=lambda el: (0 - el['count'], el['term'])),
+                "name": field,
+                "values": values,
+                "more": more,
+                "expanded": field in expand,
             })
 
+    timings.mark('facets')
+
+    context['date_histogram'] = date_histogram(facet_counts.get('years', {}), date_from, date_to)
+    context['facets_approximate'] = facet_counts['approximate']
     context['matches'] = matches
     context['facets'] = facets
     context['filters'] = active_facets
     context['pager'] = pager
+    context['max_page'] = max(1, max_offset // page_size) if max_offset else None
+    context['next_cursor'] = None
+    context['after'] = None
     context['querystring'] = querystring
+    context['sort'] = sort
+    context['sort_modes'] = [ 'relevance' ] + list(SORT_MODES)
+    context['date_from'] = date_from
+    context['date_to'] = date_to
+    if cache_key is not None:
+        cache.set(cache_key, context)
+        context = dict(context)
+    context['cache_hit'] = False
+    context['timings'] = timings
     return context
 
-class MarcXMLRecord(Record):
+def facet_values(query_params, field, contains=None, offset=0, limit=FACET_PAGE_SIZE,
+                 facet_sample_size=FACET_SAMPLE_SIZE, readers=None, collapse=True):
+    """A page of the values of a facet for the search parameters, the
+    most common first, optionally only the ones containing contains.
+    collapse is the one of the searches whose counts can be reused.
+    Returns None for the fields without a facet."""
+    if field not in FIELD_MAPPING or not FIELD_MAPPING[field][2] or field == 'date':
+        return None
+    if readers is None:
+        readers = READERS
+    db, queryparser = readers.get()
+    querystring = query_params.get("query")
+    date_from = parse_year(query_params.get("date_from"))
+    date_to = parse_year(query_params.get("date_to"))
+    query, active_facets, filter_queries = build_query(queryparser, querystring, query_params,
+                                                       date_from, date_to)
+    counts = None
+    if not querystring:
+        cached = FACET_COUNTS.get(readers.revision(),
+                                  facet_cache_key(active_facets, date_from, date_to, collapse))
+        if cached is not None:
+            counts = cached['fields'].get(field, {})
+            approximate = cached['approximate']
+    if counts is None:
+        enquire = xapian.Enquire(db)
+        enquire.set_query(query)
+        spy = xapian.ValueCountMatchSpy(FIELD_MAPPING[field][0])
+        enquire.add_matchspy(spy)
+        check_at_least = db.get_doccount()
+        if facet_sample_size and (querystring or len(filter_queries)):
+            check_at_least = min(check_at_least, facet_sample_size)
+        mset = enquire.get_mset(0, 0, check_at_least)
+        approximate = spy.get_total() < mset.get_matches_upper_bound()
+        schema_version = get_schema_version(db)
+        counts = {}
+        for facet in spy.values():
+            for facet_value in decode_facet_values(facet.term, schema_version):
+                counts[facet_value] = counts.get(facet_value, 0) + facet.termfreq
+    if contains:
+        needle = title_sort_key(contains)
+        counts = { value: count for value, count in counts.items() if needle in title_sort_key(value) }
+    page = heapq.nsmallest(offset + limit, counts.items(), key=facet_sort_key)[offset:]
+    return {
+        "field": field,
+        "total": len(counts),
+        "offset": offset,
+        "limit": limit,
+        "approximate": approximate,
+        "values": [
+            {
+                "term": facet_value,
+                "count": count,
+                "active": facet_value in active_facets[field],
+            } for facet_value, count in page
+        ],
+    }
+
+def export_records(query_params, chunk_size=EXPORT_CHUNK_SIZE, path=XAPIAN_DB, collapse=True):
+    """Generate the StoredRecord of every match of the search parameters,
+    with the copies collapsed as in search().
+
+    The matches are fetched chunk_size at a time from a database opened
+    for the export alone, so the memory doesn't depend on the number of
+    results. If a commit invalidates the database in the middle, it is
+    reopened and the export goes on from the same offset.
+    """
+    db = xapian.Database(path)
+    try:
+        querystring = query_params.get("query")
+        query, active_facets, filter_queries = build_query(build_queryparser(db),
+                                                           querystring, query_params,
+                                                           parse_year(query_params.get("date_from")),
+                                                           parse_year(query_params.get("date_to")))
+        enquire = xapian.Enquire(db)
+        enquire.set_query(query)
+        if collapse:
+            enquire.set_collapse_key(CLUSTER_SLOT)
+        sort = query_params.get("sort")
+        if sort in SORT_MODES:
+            slot, descending = SORT_MODES[sort]
+            enquire.set_sort_by_value(slot, descending)
+        start = 0
+        while True:
+            try:
+                mset = enquire.get_mset(start, chunk_size)
+                records = [ StoredRecord(match.document.get_data()) for match in mset ]
+            except xapian.DatabaseModifiedError:
+                db.reopen()
+                continue
+            for record in records:
+                yield record
+            if mset.size() < chunk_size:
+                break
+            start += chunk_size
+    finally:
+        db.close()
+
+class HarvestRecord(Record):
+    """OAI record parsing its metadata once, on first access.
+
+    Sickle's Record parses the metadata in the constructor and every
+    get_metadata() call parses it again. parse_time holds the seconds
+    spent parsing.
+    """
+    def __init__(self, record_element, strip_ns=True):
+        OAIItem.__init__(self, record_element, strip_ns=strip_ns)
+        self.header = Header(self.xml.find(
+            './/' + self._oai_namespace + 'header'))
+        self.deleted = self.header.deleted
+        self.parse_time = None
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            start = time.perf_counter()
+            if self.deleted:
+                self._metadata = {}
+            else:
+                self._metadata = self.get_metadata()
+            self.parse_time = time.perf_counter() - start
+        return self._metadata
+
+
+MARC21_NAMESPACE = '{http://www.loc.gov/MARC21/slim}'
+OAI_NAMESPACE = '{http://www.openarchives.org/OAI/2.0/}'
+
+# target, tag, subfield codes
+MARC21_SPECS = [
+    # for now consider 720a the authors, including contributors
+    # ('contributor', '720',  'a'),
+    ('coverage', '500',  ('a')),
+    ('creator', '100',  ('a')),
+    ('creator', '720',  ('a')),
+    ('date', '260',  ('c')),
+    ('date', '363', ('i')), # normalized date
+    ('date', '264', ('c')),
+    ('description', '300', ('a', 'b', 'c', 'e')),
+    ('description', '500', ('a')),
+    ('description', '520',  ('a')),
+    ('format', '856',  ('q')),
+    ('identifier', '024',  ('a')),
+    ('identifier', '856', ('u')),
+    ('language', '546',  ('a')),
+    ('language', '041', ('a')),
+    ('publisher', '260',  ('b')),
+    ('publisher', '264',  ('b')),
+    ('publisher', '264', ('a', 'c')), # this is actually the place + date
+    ('relation', '787',  ('n')),
+    ('rights', '540',  ('a')),
+    ('source', '786',  ('n')),
+    ('subject', '653',  ('a')),
+    ('title', '245',  ('a', 'b')),
+    ('title', '246',  ('a')),
+    ('type', '655',  ('a')),
+    ('type', '336',  ('a')),
+]
+
+def compile_marc_specs(specs):
+    """Build the tag => [ (spec index, target, codes) ] dispatch table"""
+    table = {}
+    for index, spec in enumerate(specs):
+        target, tag, codes = spec
+        table.setdefault(tag, []).append((index, target, tuple(codes)))
+    return table
+
+MARC21_DISPATCH = compile_marc_specs(MARC21_SPECS)
+
+def extract_marc_fields(node, specs=MARC21_SPECS, dispatch=MARC21_DISPATCH):
+    # values are collected per spec and joined in the specs order, so
+    # the output is the same as looking up each spec in turn.
+    buckets = [ [] for spec in specs ]
+    for datafield in node.iter(MARC21_NAMESPACE + 'datafield'):
+        rules = dispatch.get(datafield.get('tag'))
+        if rules is None:
+            continue
+        subfields = {}
+        for sf in datafield.iter(MARC21_NAMESPACE + 'subfield'):
+            if sf.text is not None:
+                subfields.setdefault(sf.get('code'), []).append(sf.text)
+        for index, target, codes in rules:
+            values = []
+            for code in codes:
+                values.extend(subfields.get(code, ()))
+            if len(values):
+                buckets[index].append(' '.join(values))
+
+    out = {}
+    for spec, values in zip(specs, buckets):
+        out.setdefault(spec[0], []).extend(values)
+    return out
+
+
+class MarcXMLRecord(HarvestRecord):
     def get_metadata(self):
-        ns = { None: 'http://www.loc.gov/MARC21/slim' }
-        specs = [
-            # for now consider 720a the authors, including contributors
-            # ('contributor', '720',  'a'),
-            ('coverage', '500',  ('a')),
-            ('creator', '100',  ('a')),
-            ('creator', '720',  ('a')),
-            ('date', '260',  ('c')),
-            ('date', '363', ('i')), # normalized date
-            ('date', '264', ('c')),
-            ('description', '300', ('a', 'b', 'c', 'e')),
-            ('description', '500', ('a')),
-            ('description', '520',  ('a')),
-            ('format', '856',  ('q')),
-            ('identifier', '024',  ('a')),
-            ('identifier', '856', ('u')),
-            ('language', '546',  ('a')),
-            ('language', '041', ('a')),
-            ('publisher', '260',  ('b')),
-            ('publisher', '264',  ('b')),
-            ('publisher', '264', ('a', 'c')), # this is actually the place + date
-            ('relation', '787',  ('n')),
-            ('rights', '540',  ('a')),
-            ('source', '786',  ('n')),
-            ('subject', '653',  ('a')),
-            ('title', '245',  ('a', 'b')),
-            ('title', '246',  ('a')),
-            ('type', '655',  ('a')),
-            ('type', '336',  ('a')),
-        ]
-        out = {}
-        for node in self.xml.findall('.//' + self._oai_namespace + 'metadata'):
-            for spec in specs:
-                target, tag, codes = spec
-                if not target in out:
-                    out[target] = []
-                for el in node.findall('.//datafield[@tag="{0}"]'.format(tag), namespaces=ns):
-                    values = []
-                    for code in codes:
-                        values.extend([ sf.text for sf in el.findall('.//subfield[@code="{0}"]'.format(code),
-                                                                     namespaces=ns) ])
-                    if len(values):
-                        out[target].extend([' '.join(values)])
-            break
-        return out
+        for node in self.xml.iter(self._oai_namespace + 'metadata'):
+            return extract_marc_fields(node)
+        return {}
 
-def iso_lang_code(code):
-    if not code:
-        return None
+# ISO 639-2 terminology codes => ISO 639-1
+ISO_639_2 = {
+    'abk': 'ab',
+    'aar': 'aa',
+    'afr': 'af',
+    'aka': 'ak',
+    'sqi': 'sq',
+    'amh': 'am',
+    'ara': 'ar',
+    'arg': 'an',
+    'hye': 'hy',
+    'asm': 'as',
+    'ava': 'av',
+    'ave': 'ae',
+    'aym': 'ay',
+    'aze': 'az',
+    'bam': 'bm',
+    'bak': 'ba',
+    'eus': 'eu',
+    'bel': 'be',
+    'ben': 'bn',
+    'bis': 'bi',
+    'bos': 'bs',
+    'bre': 'br',
+    'bul': 'bg',
+    'mya': 'my',
+    'cat': 'ca',
+    'cha': 'ch',
+    'che': 'ce',
+    'nya': 'ny',
+    'zho': 'zh',
+    'chu': 'cu',
+    'chv': 'cv',
+    'cor': 'kw',
+    'cos': 'co',
+    'cre': 'cr',
+    'hrv': 'hr',
+    'ces': 'cs',
+    'dan': 'da',
+    'div': 'dv',
+    'nld': 'nl',
+    'dzo': 'dz',
+    'eng': 'en',
+    'epo': 'eo',
+    'est': 'et',
+    'ewe': 'ee',
+    'fao': 'fo',
+    'fij': 'fj',
+    'fin': 'fi',
+    'fra': 'fr',
+    'fry': 'fy',
+    'ful': 'ff',
+    'gla': 'gd',
+    'glg': 'gl',
+    'lug': 'lg',
+    'kat': 'ka',
+    'deu': 'de',
+    'ell': 'el',
+    'kal': 'kl',
+    'grn': 'gn',
+    'guj': 'gu',
+    'hat': 'ht',
+    'hau': 'ha',
+    'heb': 'he',
+    'her': 'hz',
+    'hin': 'hi',
+    'hmo': 'ho',
+    'hun': 'hu',
+    'isl': 'is',
+    'ido': 'io',
+    'ibo': 'ig',
+    'ind': 'id',
+    'ina': 'ia',
+    'ile': 'ie',
+    'iku': 'iu',
+    'ipk': 'ik',
+    'gle': 'ga',
+    'ita': 'it',
+    'jpn': 'ja',
+    'jav': 'jv',
+    'kan': 'kn',
+    'kau': 'kr',
+    'kas': 'ks',
+    'kaz': 'kk',
+    'khm': 'km',
+    'kik': 'ki',
+    'kin': 'rw',
+    'kir': 'ky',
+    'kom': 'kv',
+    'kon': 'kg',
+    'kor': 'ko',
+    'kua': 'kj',
+    'kur': 'ku',
+    'lao': 'lo',
+    'lat': 'la',
+    'lav': 'lv',
+    'lim': 'li',
+    'lin': 'ln',
+    'lit': 'lt',
+    'lub': 'lu',
+    'ltz': 'lb',
+    'mkd': 'mk',
+    'mlg': 'mg',
+    'msa': 'ms',
+    'mal': 'ml',
+    'mlt': 'mt',
+    'glv': 'gv',
+    'mri': 'mi',
+    'mar': 'mr',
+    'mah': 'mh',
+    'mon': 'mn',
+    'nau': 'na',
+    'nav': 'nv',
+    'nde': 'nd',
+    'nbl': 'nr',
+    'ndo': 'ng',
+    'nep': 'ne',
+    'nor': 'no',
+    'nob': 'nb',
+    'nno': 'nn',
+    'iii': 'ii',
+    'oci': 'oc',
+    'oji': 'oj',
+    'ori': 'or',
+    'orm': 'om',
+    'oss': 'os',
+    'pli': 'pi',
+    'pus': 'ps',
+    'fas': 'fa',
+    'pol': 'pl',
+    'por': 'pt',
+    'pan': 'pa',
+    'que': 'qu',
+    'ron': 'ro',
+    'roh': 'rm',
+    'run': 'rn',
+    'rus': 'ru',
+    'sme': 'se',
+    'smo': 'sm',
+    'sag': 'sg',
+    'san': 'sa',
+    'srd': 'sc',
+    'srp': 'sr',
+    'sna': 'sn',
+    'snd': 'sd',
+    'sin': 'si',
+    'slk': 'sk',
+    'slv': 'sl',
+    'som': 'so',
+    'sot': 'st',
+    'spa': 'es',
+    'sun': 'su',
+    'swa': 'sw',
+    'ssw': 'ss',
+    'swe': 'sv',
+    'tgl': 'tl',
+    'tah': 'ty',
+    'tgk': 'tg',
+    'tam': 'ta',
+    'tat': 'tt',
+    'tel': 'te',
+    'tha': 'th',
+    'bod': 'bo',
+    'tir': 'ti',
+    'ton': 'to',
+    'tso': 'ts',
+    'tsn': 'tn',
+    'tur': 'tr',
+    'tuk': 'tk',
+    'twi': 'tw',
+    'uig': 'ug',
+    'ukr': 'uk',
+    'urd': 'ur',
+    'uzb': 'uz',
+    'ven': 've',
+    'vie': 'vi',
+    'vol': 'vo',
+    'wln': 'wa',
+    'cym': 'cy',
+    'wol': 'wo',
+    'xho': 'xh',
+    'yid': 'yi',
+    'yor': 'yo',
+    'zha': 'za',
+    'zul': 'zu',
+}
 
-    if len(code) == 2:
-        return code.lower()
-
-    if len(code) == 3:
-        mapping = {
-            'abk': 'ab',
-            'aar': 'aa',
-            'afr': 'af',
-            'aka': 'ak',
-            'sqi': 'sq',
-            'amh': 'am',
-            'ara': 'ar',
-            'arg': 'an',
-            'hye': 'hy',
-            'asm': 'as',
-            'ava': 'av',
-            'ave': 'ae',
-            'aym': 'ay',
-            'aze': 'az',
-            'bam': 'bm',
-            'bak': 'ba',
-            'eus': 'eu',
-            'bel': 'be',
-            'ben': 'bn',
-            'bis': 'bi',
-            'bos': 'bs',
-            'bre': 'br',
-            'bul': 'bg',
-            'mya': 'my',
-            'cat': 'ca',
-            'cha': 'ch',
-            'che': 'ce',
-            'nya': 'ny',
-            'zho': 'zh',
-            'chu': 'cu',
-            'chv': 'cv',
-            'cor': 'kw',
-            'cos': 'co',
-            'cre': 'cr',
-            'hrv': 'hr',
-            'ces': 'cs',
-            'dan': 'da',
-            'div': 'dv',
-            'nld': 'nl',
-            'dzo': 'dz',
-            'eng': 'en',
-            'epo': 'eo',
-            'est': 'et',
-            'ewe': 'ee',
-            'fao': 'fo',
-            'fij': 'fj',
-            'fin': 'fi',
-            'fra': 'fr',
-            'fry': 'fy',
-            'ful': 'ff',
-            'gla': 'gd',
-            'glg': 'gl',
-            'lug': 'lg',
-            'kat': 'ka',
-            'deu': 'de',
-            'ell': 'el',
-            'kal': 'kl',
-            'grn': 'gn',
-            'guj': 'gu',
-            'hat': 'ht',
-            'hau': 'ha',
-            'heb': 'he',
-            'her': 'hz',
-            'hin': 'hi',
-            'hmo': 'ho',
-            'hun': 'hu',
-            'isl': 'is',
-            'ido': 'io',
-            'ibo': 'ig',
-            'ind': 'id',
-            'ina': 'ia',
-            'ile': 'ie',
-            'iku': 'iu',
-            'ipk': 'ik',
-            'gle': 'ga',
-            'ita': 'it',
-            'jpn': 'ja',
-            'jav': 'jv',
-            'kan': 'kn',
-            'kau': 'kr',
-            'kas': 'ks',
-            'kaz': 'kk',
-            'khm': 'km',
-            'kik': 'ki',
-            'kin': 'rw',
-            'kir': 'ky',
-            'kom': 'kv',
-            'kon': 'kg',
-            'kor': 'ko',
-            'kua': 'kj',
-            'kur': 'ku',
-            'lao': 'lo',
-            'lat': 'la',
-            'lav': 'lv',
-            'lim': 'li',
-            'lin': 'ln',
-            'lit': 'lt',
-            'lub': 'lu',
-            'ltz': 'lb',
-            'mkd': 'mk',
-            'mlg': 'mg',
-            'msa': 'ms',
-            'mal': 'ml',
-            'mlt': 'mt',
-            'glv': 'gv',
-            'mri': 'mi',
-            'mar': 'mr',
-            'mah': 'mh',
-            'mon': 'mn',
-            'nau': 'na',
-            'nav': 'nv',
-            'nde': 'nd',
-            'nbl': 'nr',
-            'ndo': 'ng',
-            'nep': 'ne',
-            'nor': 'no',
-            'nob': 'nb',
-            'nno': 'nn',
-            'iii': 'ii',
-            'oci': 'oc',
-            'oji': 'oj',
-            'ori': 'or',
-            'orm': 'om',
-            'oss': 'os',
-            'pli': 'pi',
-            'pus': 'ps',
-            'fas': 'fa',
-            'pol': 'pl',
-            'por': 'pt',
-            'pan': 'pa',
-            'que': 'qu',
-            'ron': 'ro',
-            'roh': 'rm',
-            'run': 'rn',
-            'rus': 'ru',
-            'sme': 'se',
-            'smo': 'sm',
-            'sag': 'sg',
-            'san': 'sa',
-            'srd': 'sc',
-            'srp': 'sr',
-            'sna': 'sn',
-            'snd': 'sd',
-            'sin': 'si',
-            'slk': 'sk',
-            'slv': 'sl',
-            'som': 'so',
-            'sot': 'st',
-            'spa': 'es',
-            'sun': 'su',
-            'swa': 'sw',
-            'ssw': 'ss',
-            'swe': 'sv',
-            'tgl': 'tl',
-            'tah': 'ty',
-            'tgk': 'tg',
-            'tam': 'ta',
-            'tat': 'tt',
-            'tel': 'te',
-            'tha': 'th',
-            'bod': 'bo',
-            'tir': 'ti',
-            'ton': 'to',
-            'tso': 'ts',
-            'tsn': 'tn',
-            'tur': 'tr',
-            'tuk': 'tk',
-            'twi': 'tw',
-            'uig': 'ug',
-            'ukr': 'uk',
-            'urd': 'ur',
-            'uzb': 'uz',
-            'ven': 've',
-            'vie': 'vi',
-            'vol': 'vo',
-            'wln': 'wa',
-            'cym': 'cy',
-            'wol': 'wo',
-            'xho': 'xh',
-            'yid': 'yi',
-            'yor': 'yo',
-            'zha': 'za',
-            'zul': 'zu',
-        }
-        return mapping.get(code.lower(), code.lower())
+# ISO 639-2 bibliographic codes, where they differ from the
+# terminology ones
+ISO_639_2_B = {
+    'alb': 'sq',
+    'arm': 'hy',
+    'baq': 'eu',
+    'bur': 'my',
+    'chi': 'zh',
+    'cze': 'cs',
+    'dut': 'nl',
+    'fre': 'fr',
+    'geo': 'ka',
+    'ger': 'de',
+    'gre': 'el',
+    'ice': 'is',
+    'mac': 'mk',
+    'mao': 'mi',
+    'may': 'ms',
+    'per': 'fa',
+    'rum': 'ro',
+    'slo': 'sk',
+    'tib': 'bo',
+    'wel': 'cy',
+}
 
+# Language names found in the records, in English and in the language
+# itself, without accents and lowercase
+LANGUAGE_NAMES = {
+    'albanian': 'sq', 'shqip': 'sq',
+    'arabic': 'ar',
+    'basque': 'eu', 'euskara': 'eu',
+    'bosnian': 'bs', 'bosanski': 'bs',
+    'bulgarian': 'bg',
+    'catalan': 'ca', 'catala': 'ca',
+    'chinese': 'zh',
+    'croatian': 'hr', 'hrvatski': 'hr',
+    'czech': 'cs', 'cestina': 'cs',
+    'danish': 'da', 'dansk': 'da',
+    'dutch': 'nl', 'nederlands': 'nl',
+    'english': 'en',
+    'esperanto': 'eo',
+    'estonian': 'et', 'eesti': 'et',
+    'finnish': 'fi', 'suomi': 'fi',
+    'french': 'fr', 'francais': 'fr',
+    'galician': 'gl', 'galego': 'gl',
+    'german': 'de', 'deutsch': 'de',
+    'greek': 'el',
+    'hebrew': 'he',
+    'hindi': 'hi',
+    'hungarian': 'hu', 'magyar': 'hu',
+    'icelandic': 'is', 'islenska': 'is',
+    'indonesian': 'id', 'bahasa indonesia': 'id',
+    'irish': 'ga', 'gaeilge': 'ga',
+    'italian': 'it', 'italiano': 'it',
+    'japanese': 'ja',
+    'korean': 'ko',
+    'latin': 'la', 'latina': 'la',
+    'latvian': 'lv', 'latviesu': 'lv',
+    'lithuanian': 'lt', 'lietuviu': 'lt',
+    'macedonian': 'mk',
+    'norwegian': 'no', 'norsk': 'no',
+    'persian': 'fa', 'farsi': 'fa',
+    'polish': 'pl', 'polski': 'pl',
+    'portuguese': 'pt', 'portugues': 'pt',
+    'romanian': 'ro', 'romana': 'ro',
+    'russian': 'ru',
+    'serbian': 'sr', 'srpski': 'sr',
+    'slovak': 'sk', 'slovencina': 'sk',
+    'slovenian': 'sl', 'slovene': 'sl', 'slovenscina': 'sl',
+    'spanish': 'es', 'espanol': 'es', 'castellano': 'es',
+    'swedish': 'sv', 'svenska': 'sv',
+    'tagalog': 'tl',
+    'turkish': 'tr', 'turkce': 'tr',
+    'ukrainian': 'uk',
+    'welsh': 'cy', 'cymraeg': 'cy',
+    'yiddish': 'yi',
+}
 
-def harvest(**opts):
-    url = opts.pop('url')
-    hostname = urlparse(url).hostname
-    if opts['metadataPrefix'] == 'marc21':
-        sickle = Sickle(url, class_mapping={
-            "ListRecords": MarcXMLRecord,
-            "GetRecord": MarcXMLRecord,
-        })
-    else:
-        sickle = Sickle(url)
+def _language_table():
+    table = {}
+    for code in ISO_639_2.values():
+        table[code] = code
+    table.update(ISO_639_2)
+    table.update(ISO_639_2_B)
+    table.update(LANGUAGE_NAMES)
+    return table
 
-    try:
-        records = sickle.ListRecords(**opts)
-    except NoRecordsMatch:
-        return
-    except Exception as e:
-        print(e)
-        return
+# anything above => ISO 639-1, built once
+LANGUAGE_TABLE = _language_table()
+
+LANGUAGE_SEPARATOR_RE = re.compile(r'\s*[;,/|]\s*|\s+(?:and|&)\s+')
+
+def language_key(value):
+    decomposed = unicodedata.normalize('NFKD', value)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
 
-    db = xapian.WritableDatabase(XAPIAN_DB, xapian.DB_CREATE_OR_OPEN)
-    termgenerator = xapian.TermGenerator()
-    termgenerator.set_stemmer(xapian.Stem("none"))
+@functools.lru_cache(maxsize=4096)
+def language_codes(value):
+    """Tuple of the ISO 639-1 codes of a language value: a 2 or 3
+    letter code (en, eng, en-US), a name (English) or a list of them
+    (eng; ita). Unknown 3 letter codes are kept as they are, unknown
+    names are dropped."""
+    codes = []
+    for part in LANGUAGE_SEPARATOR_RE.split(language_key(value or '')):
+        if not part:
+            continue
+        found = LANGUAGE_TABLE.get(part)
+        if found is None:
+            # en-US, pt_BR
+            primary = re.split(r'[-_]', part)[0]
+            found = LANGUAGE_TABLE.get(primary)
+            if found is None and len(primary) in (2, 3) and primary.isalpha():
+                found = primary
+        if found is None and ' ' in part:
+            # eng ita
+            tokens = [ LANGUAGE_TABLE.get(token) for token in part.split() ]
+            if all(tokens):
+                codes.extend(tokens)
+                continue
+        if found is not None:
+            codes.append(found)
+    return tuple(dict.fromkeys(codes))
 
-    logs = []
-    tried = []
+def normalize_languages(values):
+    """The distinct codes of a list of language values"""
+    codes = []
+    for value in values or []:
+        codes.extend(language_codes(value))
+    return list(dict.fromkeys(codes))
+
+def iso_lang_code(code):
+    """The first code of a language value, or None"""
+    codes = language_codes(code)
+    if codes:
+        return codes[0]
+    return None
+
+
+def fetch_records(sickle, opts, resumption_token=None, stats=None):
+    """Yield the records of a ListRecords request with the resumption
+    token of the page they come from (None for the first page).
+
+    The time spent fetching and reading the pages and the number of
+    records are added to the stats."""
+    if stats is None:
+        stats = harvest_stats()
+    start = time.perf_counter()
     try:
-        for rec in records:
-            rec.get_metadata()
-            tried.append(rec)
-    except Exception as e:
-        print(e)
+        if resumption_token:
+            records = sickle.ListRecords(resumptionToken=resumption_token)
+        else:
+            records = sickle.ListRecords(**opts)
+    finally:
+        stats['fetch_time'] += time.perf_counter() - start
+    page_token = resumption_token
+    next_token = records.resumption_token
+    while True:
+        start = time.perf_counter()
+        try:
+            rec = next(records)
+        except StopIteration:
+            break
+        finally:
+            stats['fetch_time'] += time.perf_counter() - start
+        stats['fetched'] += 1
+        # the iterator fetched the next page to return this record
+        if records.resumption_token is not next_token:
+            page_token = next_token.token
+            next_token = records.resumption_token
+        yield page_token, rec
 
-    for rec in tried:
-        # print(rec)
-        record = rec.get_metadata()
-        is_deleted = rec.deleted
+def parse_records(records, hostname, stats):
+    for page_token, rec in records:
+        record = dict(rec.metadata)
+        stats['parse_time'] += rec.parse_time
+        if rec.parse_time > HARVEST_SLOW_PARSE:
+            logger.warning("Parsing {0} took {1:.3f}s".format(rec.header.identifier,
+                                                               rec.parse_time))
+        record['hostname'] = [ hostname ]
+        yield page_token, rec, record
+
+def build_documents(parsed, termgenerator, stats=None):
+    for page_token, rec, record in parsed:
+        start = time.perf_counter()
         # this is the link, we need the record header and store that
         identifier = rec.header.identifier
+        idterm = u"Q" + identifier
+        if rec.deleted:
+            yield page_token, idterm, None
+            continue
+
         doc = xapian.Document()
         termgenerator.set_document(doc)
-        record['hostname'] = [ hostname ]
 
         for field in FIELD_MAPPING:
             values = record.get(field)
             slot, prefix, is_boolean = FIELD_MAPPING[field]
+            if field == 'language':
+                values = normalize_languages(values)
             if values:
                 value_list = []
                 for v in values:
                     # if it's a boolean, add it so
-                    if field == 'language':
-                        v = iso_lang_code(v)
-                        if v is None:
-                            continue
-
                     if is_boolean:
                         doc.add_boolean_term(prefix + v.lower())
                     # but index it anyway
                     termgenerator.index_text(v, 1, prefix)
                     value_list.append(v)
 
-                doc.add_value(slot, json.dumps(value_list))
+                doc.add_value(slot, encode_facet_values(value_list))
+        add_sort_values(doc, record.get('title'), record.get('date'))
+        languages = normalize_languages(record.get('language'))
+        add_dedup_terms(doc,
+                        record_fingerprint(record.get('title'), record.get('creator'), languages),
+                        record.get('identifier'))
+        add_suggest_terms(doc, record)
 
         # general search
         termgenerator.increase_termpos()
@@ -462,14 +1731,744 @@ def harvest(**opts):
                 for v in values:
                     termgenerator.index_text(v)
 
-        record['oai_pmh_identifier'] = identifier
-        doc.set_data(json.dumps(record))
-        idterm = u"Q" + identifier
+        doc.set_data(json.dumps(stored_record(record, identifier), separators=(',', ':')))
         doc.add_boolean_term(idterm)
-        if is_deleted:
-            logs.append("Removing document " + idterm)
-            db.delete_document(idterm)
+        if stats is not None:
+            stats['build_time'] += time.perf_counter() - start
+        yield page_token, idterm, doc
+
+class IndexWriter:
+    """The single writer of the index.
+
+    Commits every commit_every documents or commit_interval seconds.
+    Each commit stores, for every site being harvested, the resumption
+    token of the page being indexed, so a crashed run can restart from
+    that page.
+    """
+    def __init__(self, db,
+                 commit_every=HARVEST_COMMIT_EVERY,
+                 commit_interval=HARVEST_COMMIT_INTERVAL):
+        self.db = db
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.last_commit = time.monotonic()
+        self.page_tokens = {}
+        self.dirty = {}
+
+    def write(self, token_key, page_token, idterm, doc, stats):
+        start = time.perf_counter()
+        if doc is None:
+            stats['logs'].append("Removing document " + idterm)
+            self.db.delete_document(idterm)
+            stats['deleted'] += 1
         else:
-            logs.append("Indexing " + idterm)
-            db.replace_document(idterm, doc)
-    return logs
+            stats['logs'].append("Indexing " + idterm)
+            assign_cluster(self.db, idterm, doc)
+            self.db.replace_document(idterm, doc)
+            stats['indexed'] += 1
+        self.page_tokens[token_key] = page_token
+        self.dirty[token_key] = stats
+        self.pending += 1
+        if self.pending >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit()
+        stats['write_time'] += time.perf_counter() - start
+
+    def finish(self, token_key, stats):
+        # the list was walked to the end, or the token expired: either
+        # way the next run starts from scratch
+        if stats['completed'] or stats['restart']:
+            self.page_tokens[token_key] = None
+        self.dirty[token_key] = stats
+        start = time.perf_counter()
+        self.commit()
+        stats['write_time'] += time.perf_counter() - start
+        self.page_tokens.pop(token_key, None)
+        stats['duration'] = time.monotonic() - stats['started']
+
+    def commit(self):
+        for token_key in self.page_tokens:
+            self.db.set_metadata(token_key, self.page_tokens[token_key] or '')
+        self.db.commit()
+        for stats in self.dirty.values():
+            stats['commits'] += 1
+        self.dirty = {}
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+
+def open_index(path=XAPIAN_DB):
+    db = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+    if db.get_doccount() and get_schema_version(db) < SCHEMA_VERSION:
+        print("The index at " + path + " uses an old layout, "
+              "please run manage.py upgrade_index first")
+        db.close()
+        return None
+    db.set_metadata('schema_version', str(SCHEMA_VERSION))
+    return db
+
+_sessions = threading.local()
+
+def http_session():
+    """The keep-alive HTTP session of the current thread, reused for
+    every page and site the thread fetches"""
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HARVEST_HTTP_POOL,
+                                                pool_maxsize=HARVEST_HTTP_POOL)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # requests decompresses the bodies transparently
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        _sessions.session = session
+    return session
+
+
+class HarvestResponse(OAIResponse):
+    """OAIResponse parsing the XML once instead of on every access"""
+    @property
+    def xml(self):
+        if getattr(self, '_xml', None) is None:
+            self._xml = etree.XML(self.http_response.content,
+                                  parser=XMLParser)
+        return self._xml
+
+
+class PrefetchingIterator(OAIItemIterator):
+    """Fetch the next page in the background while the records of the
+    current one are processed"""
+    _prefetch = None
+
+    def _next_response(self):
+        params = self.params
+        if self.resumption_token:
+            params = {
+                'resumptionToken': self.resumption_token.token,
+                'verb': self.verb
+            }
+        prefetched = self._prefetch
+        self._prefetch = None
+        if prefetched is not None and prefetched[0] == params.get('resumptionToken'):
+            self.oai_response = prefetched[1].result()
+        else:
+            self.oai_response = self.sickle.harvest(**params)
+        error = self.oai_response.xml.find(
+            './/' + self.sickle.oai_namespace + 'error')
+        if error is not None:
+            code = error.attrib.get('code', 'UNKNOWN')
+            description = error.text or ''
+            try:
+                raise getattr(
+                    oaiexceptions, code[0].upper() + code[1:])(description)
+            except AttributeError:
+                raise oaiexceptions.OAIError(description)
+        self.resumption_token = self._get_resumption_token()
+        self._items = self.oai_response.xml.iterfind(
+            './/' + self.sickle.oai_namespace + self.element)
+        if self.resumption_token and self.resumption_token.token:
+            token = self.resumption_token.token
+            self._prefetch = (token, PREFETCHER.submit(self.sickle.harvest,
+                                                       resumptionToken=token,
+                                                       verb=self.verb))
+
+
+class HarvestClient(Sickle):
+    """Sickle with pooled keep-alive connections, compressed transfers,
+    retries with backoff and prefetching of the next page.
+
+    The requests, retries and bytes on the wire are counted in stats.
+    """
+    def __init__(self, endpoint, stats=None, **kwargs):
+        kwargs.setdefault('iterator', PrefetchingIterator)
+        kwargs.setdefault('max_retries', HARVEST_MAX_RETRIES)
+        kwargs.setdefault('retry_status_codes', [ 500, 502, 503, 504 ])
+        kwargs.setdefault('timeout', HARVEST_TIMEOUT)
+        super().__init__(endpoint, **kwargs)
+        self.stats = stats
+
+    def _count(self, what, value=1):
+        if self.stats is not None:
+            self.stats[what] += value
+
+    def _request(self, kwargs):
+        session = http_session()
+        if self.http_method == 'GET':
+            response = session.get(self.endpoint, params=kwargs, **self.request_args)
+        else:
+            response = session.post(self.endpoint, data=kwargs, **self.request_args)
+        self._count('requests')
+        # bytes read from the socket, before decompression
+        try:
+            transferred = response.raw.tell()
+        except AttributeError:
+            transferred = 0
+        self._count('bytes', transferred or len(response.content))
+        return response
+
+    def retry_delay(self, http_response, attempt):
+        """Seconds to wait before the next attempt: the Retry-After of
+        the server if any, otherwise an exponential backoff"""
+        if http_response is not None:
+            retry_after = http_response.headers.get('retry-after')
+            if retry_after:
+                try:
+                    delay = int(retry_after)
+                except ValueError:
+                    try:
+                        delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                    except (TypeError, ValueError):
+                        delay = None
+                if delay is not None:
+                    return min(max(delay, 0), HARVEST_MAX_RETRY_AFTER)
+        backoff = HARVEST_RETRY_BACKOFF * (2 ** attempt)
+        return min(backoff + random.uniform(0, backoff / 2), HARVEST_MAX_RETRY_AFTER)
+
+    def harvest(self, **kwargs):
+        attempt = 0
+        while True:
+            http_response = None
+            try:
+                http_response = self._request(kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("{0}: {1}".format(self.endpoint, e))
+            else:
+                if http_response.status_code not in self.retry_status_codes \
+                   or attempt >= self.max_retries:
+                    break
+                logger.warning("{0}: HTTP {1}".format(self.endpoint, http_response.status_code))
+            delay = self.retry_delay(http_response, attempt)
+            logger.warning("Retrying {0} in {1:.1f}s".format(self.endpoint, delay))
+            self._count('retries')
+            time.sleep(delay)
+            attempt += 1
+        http_response.raise_for_status()
+        if self.encoding:
+            http_response.encoding = self.encoding
+        return HarvestResponse(http_response, params=kwargs)
+
+
+def oai_client(url, metadata_prefix, stats=None):
+    record_class = HarvestRecord
+    if metadata_prefix == 'marc21':
+        record_class = MarcXMLRecord
+    return HarvestClient(url, stats=stats, class_mapping={
+        "ListRecords": record_class,
+        "GetRecord": record_class,
+    })
+
+def harvest_stats():
+    return {
+        "fetched": 0,
+        "indexed": 0,
+        "deleted": 0,
+        "commits": 0,
+        "requests": 0,
+        "retries": 0,
+        "bytes": 0,
+        "fetch_time": 0.0,
+        "parse_time": 0.0,
+        "build_time": 0.0,
+        "write_time": 0.0,
+        "started": time.monotonic(),
+        "duration": 0.0,
+        "completed": False,
+        "restart": False,
+        "duplicate_of": None,
+        "errors": deque(maxlen=HARVEST_LOG_LINES),
+        "logs": deque(maxlen=HARVEST_LOG_LINES),
+    }
+
+def duplicate_stats(stats, key):
+    """The stats of a job harvested together with the job key, which
+    has the stats given"""
+    duplicate = harvest_stats()
+    duplicate['duplicate_of'] = key
+    duplicate['completed'] = stats['completed']
+    duplicate['restart'] = stats['restart']
+    duplicate['logs'] = list(duplicate['logs'])
+    duplicate['errors'] = list(duplicate['errors'])
+    return duplicate
+
+def failed_stats(stats, reason):
+    """The stats (new ones if None) of a site whose documents didn't go
+    live, with the reason among the errors"""
+    if stats is None:
+        stats = harvest_stats()
+    stats['completed'] = False
+    stats['errors'] = list(stats['errors']) + [ reason ]
+    stats['logs'] = list(stats['logs'])
+    return stats
+
+DONE = object()
+
+# threads fetching the next pages ahead of the harvest
+PREFETCHER = ThreadPoolExecutor(max_workers=HARVEST_HTTP_POOL)
+
+def produce_documents(opts, resumption_token, output, stats, cancel):
+    """Fetch, parse and build the documents of a site and put them in
+    the output queue, ending with a DONE marker"""
+    opts = dict(opts)
+    url = opts.pop('url')
+    hostname = urlparse(url).hostname
+    token_key = resumption_token_key(url, opts)
+    try:
+        if resumption_token:
+            logger.info("Resuming " + url + " from " + resumption_token)
+        termgenerator = xapian.TermGenerator()
+        termgenerator.set_stemmer(xapian.Stem("none"))
+        stats['started'] = time.monotonic()
+        records = fetch_records(oai_client(url, opts['metadataPrefix'], stats),
+                                opts, resumption_token, stats)
+        parsed = parse_records(records, hostname, stats)
+        documents = build_documents(parsed, termgenerator, stats)
+        for page_token, idterm, doc in documents:
+            if cancel.is_set():
+                return
+            output.put((token_key, page_token, idterm, doc))
+        stats['completed'] = True
+    except NoRecordsMatch:
+        stats['completed'] = True
+    except BadResumptionToken as e:
+        # expired, start over on the next run
+        print(e)
+        stats['errors'].append(repr(e))
+        stats['restart'] = True
+    except Exception as e:
+        print(e)
+        stats['errors'].append(repr(e))
+    finally:
+        output.put((token_key, DONE, None, None))
+
+class HostScheduler:
+    """Submit jobs to an executor, at most per_host at once for the same
+    host. The others wait in the queue of their host, without taking a
+    worker thread, and are submitted as soon as a job of the host is
+    over. submit() returns a future with the outcome of the job."""
+    def __init__(self, executor, per_host=HARVEST_PER_HOST):
+        self.executor = executor
+        self.per_host = max(per_host, 1)
+        self._lock = threading.Lock()
+        self._running = {}
+        self._waiting = {}
+
+    def submit(self, hostname, func, *args):
+        future = Future()
+        with self._lock:
+            start = self._running.get(hostname, 0) < self.per_host
+            if start:
+                self._running[hostname] = self._running.get(hostname, 0) + 1
+            else:
+                self._waiting.setdefault(hostname, deque()).append((future, func, args))
+        if start:
+            self._start(hostname, future, func, args)
+        return future
+
+    def _start(self, hostname, future, func, args):
+        def done(inner):
+            self._release(hostname)
+            if inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+        self.executor.submit(func, *args).add_done_callback(done)
+
+    def _release(self, hostname):
+        with self._lock:
+            waiting = self._waiting.get(hostname)
+            if waiting:
+                job = waiting.popleft()
+            else:
+                job = None
+                self._running[hostname] -= 1
+        if job is not None:
+            self._start(hostname, *job)
+
+
+def harvest_sites(jobs, path=XAPIAN_DB, workers=1, per_host=HARVEST_PER_HOST,
+                  commit_every=HARVEST_COMMIT_EVERY,
+                  commit_interval=HARVEST_COMMIT_INTERVAL,
+                  on_done=None, suggestions=True):
+    """Harvest the (key, opts) jobs, fetching and parsing up to workers
+    sites at once and at most per_host of them from the same host.
+
+    Everything is written by the calling thread, which also calls
+    on_done(key, stats) as soon as the documents of a site have been
+    committed. A job listing the same records as an earlier one is
+    harvested with it, and reported with empty stats with the key of
+    the other one in duplicate_of. Unless suggestions is false, the
+    stored suggestions are built again if any document changed.
+    Returns a dict with the stats of each key.
+    """
+    db = open_index(path)
+    if db is None:
+        return None
+    writer = IndexWriter(db, commit_every=commit_every, commit_interval=commit_interval)
+    output = queue.Queue(maxsize=HARVEST_QUEUE_SIZE)
+    cancel = threading.Event()
+    results = {}
+    keys = {}
+    duplicates = {}
+    unique_jobs = []
+    for key, opts in jobs:
+        token_key = resumption_token_key(opts['url'], opts)
+        # the same list requested twice
+        if token_key in keys:
+            print("Harvesting " + str(key) + " together with " + str(keys[token_key]) +
+                  ", it lists the same records")
+            duplicates.setdefault(token_key, []).append(key)
+            continue
+        keys[token_key] = key
+        unique_jobs.append((key, opts))
+        results[key] = harvest_stats()
+
+    def run(key, opts):
+        token_key = resumption_token_key(opts['url'], opts)
+        if cancel.is_set():
+            output.put((token_key, DONE, None, None))
+            return
+        produce_documents(opts, tokens[token_key], output, results[key], cancel)
+
+    # looked up before any producer starts
+    tokens = { token_key: db.get_metadata(token_key).decode('utf-8') for token_key in keys }
+    remaining = len(keys)
+    failure = None
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        scheduler = HostScheduler(executor, per_host)
+        for key, opts in unique_jobs:
+            scheduler.submit(urlparse(opts['url']).hostname, run, key, opts)
+        while remaining:
+            token_key, page_token, idterm, doc = output.get()
+            if failure is not None:
+                # drain, so the producers are not stuck on a full queue
+                if page_token is DONE:
+                    remaining -= 1
+                continue
+            key = keys[token_key]
+            try:
+                if page_token is DONE:
+                    remaining -= 1
+                    writer.finish(token_key, results[key])
+                    results[key]['logs'] = list(results[key]['logs'])
+                    results[key]['errors'] = list(results[key]['errors'])
+                    if on_done:
+                        on_done(key, results[key])
+                    for duplicate in duplicates.get(token_key, []):
+                        results[duplicate] = duplicate_stats(results[key], key)
+                        if on_done:
+                            on_done(duplicate, results[duplicate])
+                else:
+                    writer.write(token_key, page_token, idterm, doc, results[key])
+            except Exception as e:
+                failure = e
+                cancel.set()
+    if failure is None:
+        writer.commit()
+        if suggestions and any(results[key]['indexed'] or results[key]['deleted'] for key in results):
+            build_suggestions(db)
+            db.commit()
+    db.close()
+    if failure is not None:
+        raise failure
+    return results
+
+def harvest(commit_every=HARVEST_COMMIT_EVERY,
+            commit_interval=HARVEST_COMMIT_INTERVAL,
+            **opts):
+    results = harvest_sites([ (opts['url'], opts) ],
+                            commit_every=commit_every,
+                            commit_interval=commit_interval)
+    if results is None:
+        return None
+    return results[opts['url']]
+
+def new_generation_path(path=XAPIAN_DB):
+    return path + '-' + datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+
+def swap_index(generation, path=XAPIAN_DB):
+    """Atomically point path to the generation directory.
+
+    path becomes a symlink, replaced with a rename, so readers see
+    either the old or the new generation and pick up the new one on
+    their next ReaderPool.get(). Returns the directory of the previous
+    generation, if any.
+    """
+    previous = None
+    if os.path.islink(path):
+        previous = os.path.realpath(path)
+    elif os.path.isdir(path):
+        # the first swap moves the plain directory out of the way
+        previous = new_generation_path(path)
+        os.rename(path, previous)
+    tmp_link = path + '.swap'
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(os.path.basename(generation), tmp_link)
+    os.replace(tmp_link, path)
+    return previous
+
+def rebuild_index(jobs, path=XAPIAN_DB, **opts):
+    """Harvest the jobs from scratch into path + '.build', compact it
+    into a new generation next to path and swap it in.
+
+    If any site fails, the live index is left untouched and the build
+    is kept: the next rebuild goes on in it, resuming each site from
+    the resumption token committed with its last batch (the completed
+    sites are harvested again).
+
+    Returns the stats of each job. If the rebuild was abandoned, none
+    of them is completed.
+    """
+    build_path = path + '.build'
+    # left by the older rebuilds, which used a build per run
+    for leftover in Path(path).parent.glob(Path(path).name + '-*.build'):
+        shutil.rmtree(leftover, ignore_errors=True)
+    if os.path.isdir(build_path):
+        build = xapian.Database(build_path)
+        outdated = build.get_doccount() and get_schema_version(build) < SCHEMA_VERSION
+        build.close()
+        if outdated:
+            print("The build at " + build_path + " uses an old layout, starting over")
+            shutil.rmtree(build_path)
+    finished = {}
+    def collect(key, stats):
+        finished[key] = stats
+    try:
+        results = harvest_sites(jobs, path=build_path, on_done=collect, **opts)
+    except Exception as e:
+        print("Rebuild of " + build_path + " failed: " + str(e))
+        return { key: failed_stats(finished.get(key), repr(e)) for key, job_opts in jobs }
+    if results is None:
+        return { key: failed_stats(None, "The build uses an old layout") for key, job_opts in jobs }
+    for key in results:
+        if not results[key]['completed']:
+            print("Harvest of " + str(key) + " failed, keeping the current index. "
+                  "The next rebuild resumes from " + build_path)
+            reason = "Rebuild abandoned, the harvest of " + str(key) + " failed"
+            return { key: failed_stats(results.get(key), reason) for key, job_opts in jobs }
+    generation = new_generation_path(path)
+    try:
+        xapian.Database(build_path).compact(generation)
+    except Exception:
+        shutil.rmtree(generation, ignore_errors=True)
+        raise
+    shutil.rmtree(build_path, ignore_errors=True)
+
+    previous = swap_index(generation, path)
+    if previous and previous != os.path.realpath(generation):
+        # readers holding it open keep working on the unlinked files
+        shutil.rmtree(previous, ignore_errors=True)
+    return results
+
+# a shard, or the build of its rebuild
+SHARD_NAME_RE = re.compile(r'(site-\w+)(?:\.build)?$')
+
+def shard_path(key, shards_dir=XAPIAN_SHARDS_DIR):
+    return os.path.join(shards_dir, 'site-' + str(key))
+
+def index_paths(sharded=False, stub=XAPIAN_STUB):
+    """The databases to maintain: the shards or the single index"""
+    if sharded:
+        if os.path.isfile(stub):
+            return stub_paths(stub)
+        return []
+    return [ XAPIAN_DB ]
+
+def drop_shard(path):
+    """Remove a shard, and its generation directory if it's a symlink"""
+    if os.path.islink(path):
+        target = os.path.realpath(path)
+        os.unlink(path)
+        shutil.rmtree(target, ignore_errors=True)
+    elif os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+def harvest_shards(jobs, shards_dir=XAPIAN_SHARDS_DIR, stub=XAPIAN_STUB,
+                   workers=1, per_host=HARVEST_PER_HOST, force=False, on_done=None,
+                   suggest_path=XAPIAN_SUGGEST_DB, **opts):
+    """Harvest each (key, opts) job into its own shard, up to workers
+    sites at once and at most per_host of them from the same host.
+
+    Each shard has its own writer, so sites are committed, rebuilt (with
+    force, see rebuild_index) and compacted independently. Then the
+    stub lists the shards of the jobs, and the shards of the keys not
+    among the jobs any more are dropped. on_done(key, stats) is called
+    from this thread as soon as each shard is done. The suggestions of
+    all the shards are built again in suggest_path if anything changed.
+    Returns a dict with the stats of each key.
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+
+    def run(key, job_opts):
+        path = shard_path(key, shards_dir)
+        if force:
+            return rebuild_index([ (key, job_opts) ], path=path, suggestions=False, **opts)
+        return harvest_sites([ (key, job_opts) ], path=path, suggestions=False, **opts)
+
+    results = {}
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        scheduler = HostScheduler(executor, per_host)
+        futures = {}
+        for key, job_opts in jobs:
+            futures[scheduler.submit(urlparse(job_opts['url']).hostname, run, key, job_opts)] = key
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print("Harvest of the shard of " + str(futures[future]) + " failed: " + str(e))
+                result = { futures[future]: failed_stats(None, repr(e)) }
+            if result is None:
+                result = { futures[future]: failed_stats(None, "The shard uses an old layout") }
+            for key in result:
+                results[key] = result[key]
+                if on_done:
+                    on_done(key, result[key])
+
+    current = [ shard_path(key, shards_dir) for key, job_opts in jobs ]
+    write_stub([ path for path in current if os.path.exists(path) ], stub)
+    changed = any(results[key]['indexed'] or results[key]['deleted'] for key in results)
+    # the generations (site-KEY-TIMESTAMP) go away with their shard
+    for entry in os.listdir(shards_dir):
+        path = os.path.join(shards_dir, entry)
+        match = SHARD_NAME_RE.match(entry)
+        if match and os.path.join(shards_dir, match.group(1)) not in current:
+            print("Dropping the shard " + path)
+            drop_shard(path)
+            changed = True
+    if changed or not os.path.exists(suggest_path):
+        build_shard_suggestions(stub, suggest_path)
+    return results
+
+def resumption_token_key(url, opts):
+    request = [ url, opts.get('metadataPrefix') or '', opts.get('set') or '' ]
+    return 'resumption_token:' + hashlib.sha1("\n".join(request).encode('utf-8')).hexdigest()
+
+
+def upgrade_index(path=XAPIAN_DB, batch_size=1000):
+    """Rewrite the value slots of an existing index to the current layout.
+
+    The last converted document id is committed together with each
+    batch, so an interrupted upgrade resumes where it stopped.
+    Returns the number of converted documents, or None if the index
+    was written by a newer version of the code.
+    """
+    db = xapian.WritableDatabase(path, xapian.DB_OPEN)
+    try:
+        return upgrade_database(db, batch_size)
+    finally:
+        db.close()
+
+def upgrade_database(db, batch_size=1000):
+    """upgrade_index() on an open writable database"""
+    version = get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        print("The index uses layout " + str(version) + ", newer than this code knows")
+        return None
+    if version == SCHEMA_VERSION:
+        return 0
+
+    resume_from = int(db.get_metadata('schema_upgrade_docid') or 0)
+    docids = [ item.docid for item in db.postlist('') if item.docid > resume_from ]
+    converted = 0
+    for docid in docids:
+        doc = db.get_document(docid)
+        if version < 2:
+            for field in FIELD_MAPPING:
+                slot = FIELD_MAPPING[field][0]
+                value = doc.get_value(slot)
+                if value:
+                    doc.add_value(slot, encode_facet_values(decode_facet_values(value, version)))
+        if version < 3:
+            dates = decode_facet_values(doc.get_value(FIELD_MAPPING['date'][0]))
+            add_sort_values(doc, StoredRecord(doc.get_data()).get('title'), dates)
+        if version < 4:
+            record = StoredRecord(doc.get_data())
+            languages = normalize_languages(record.get('language'))
+            add_dedup_terms(doc,
+                            record_fingerprint(record.get('title'), record.get('creator'), languages),
+                            record.get('identifiers'))
+            idterm = 'Q' + record.get('oai_pmh_identifier', str(docid))
+            assign_cluster(db, idterm, doc)
+        if version < 5:
+            record = StoredRecord(doc.get_data())
+            add_suggest_terms(doc, {
+                "title": record.get('title'),
+                "creator": record.get('creator'),
+                "subject": decode_facet_values(doc.get_value(FIELD_MAPPING['subject'][0])),
+            })
+        if version < 6:
+            refresh_languages(db, doc)
+        if version < 7 and not doc.get_value(TITLE_SORT_SLOT):
+            doc.add_value(TITLE_SORT_SLOT, TITLE_SORT_MISSING)
+        if version < 8 and not StoredRecord(doc.get_data()).get('creator'):
+            # fingerprint and cluster again, without the title alone
+            refresh_languages(db, doc)
+        db.replace_document(docid, doc)
+        converted += 1
+        if converted % batch_size == 0:
+            db.set_metadata('schema_upgrade_docid', str(docid))
+            db.commit()
+            logger.info("Upgraded {0} documents".format(converted))
+
+    db.set_metadata('schema_upgrade_docid', '')
+    db.set_metadata('schema_version', str(SCHEMA_VERSION))
+    build_suggestions(db)
+    db.commit()
+    return converted
+
+def remap_language_terms(path=XAPIAN_DB, batch_size=1000, unindexed=False):
+    """Index again the languages, fingerprint and cluster of the
+    documents indexed with codes which language_codes() now maps to
+    something else (e.g. fre => fr).
+
+    Only the documents under such terms are read, so the rest of the
+    index is untouched. With unindexed, the documents without any
+    language term are checked as well, for the values which are now
+    recognized (e.g. a new language name). Running it again picks up
+    what an interrupted run left. Returns the number of rewritten
+    documents, or None if the index must be upgraded first.
+    """
+    db = xapian.WritableDatabase(path, xapian.DB_OPEN)
+    try:
+        return remap_database_languages(db, batch_size, unindexed)
+    finally:
+        db.close()
+
+def remap_database_languages(db, batch_size=1000, unindexed=False):
+    """remap_language_terms() on an open writable database"""
+    # the slots of the older layouts can't hold the new values
+    if db.get_doccount() and get_schema_version(db) != SCHEMA_VERSION:
+        print("The index uses an old layout, please run manage.py upgrade_index first")
+        return None
+    slot, prefix, is_boolean = FIELD_MAPPING['language']
+    remap = {}
+    for item in db.allterms(prefix):
+        term = item.term.decode('utf-8')
+        value = term[len(prefix):]
+        codes = language_codes(value)
+        if codes != (value,):
+            remap[term] = codes
+    logger.info("Remapping language terms: {0}".format(remap))
+
+    docids = set()
+    for term in remap:
+        docids.update(posting.docid for posting in db.postlist(term))
+    if unindexed:
+        enquire = xapian.Enquire(db)
+        enquire.set_query(empty_value_query(slot))
+        for match in enquire.get_mset(0, db.get_doccount()):
+            if normalize_languages(StoredRecord(match.document.get_data()).get('language')):
+                docids.add(match.docid)
+    rewritten = 0
+    for docid in sorted(docids):
+        doc = db.get_document(docid)
+        refresh_languages(db, doc)
+        db.replace_document(docid, doc)
+        rewritten += 1
+        if rewritten % batch_size == 0:
+            db.commit()
+            logger.info("Remapped {0} documents".format(rewritten))
+    db.commit()
+    return rewritten
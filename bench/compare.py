@@ -0,0 +1,45 @@
+# compare two result files of bench.run
+#
+#   python -m bench.compare baseline.json current.json
+#
+import argparse
+import json
+
+def flatten(data, prefix=''):
+    out = {}
+    for key, value in data.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            out.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Flag timings slower by more than this fraction")
+    args = parser.parse_args()
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    with open(args.current) as fh:
+        current = json.load(fh)
+    print("{0} => {1}".format(baseline.get('revision'), current.get('revision')))
+    old = flatten(baseline.get('sizes', {}))
+    new = flatten(current.get('sizes', {}))
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        if not (name.endswith('_ms') or name.endswith('seconds')) or not old[name]:
+            continue
+        change = (new[name] - old[name]) / old[name]
+        flag = ''
+        if change > args.threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print("{0:60} {1:12.3f} {2:12.3f} {3:+8.1%}{4}".format(name, old[name], new[name], change, flag))
+    raise SystemExit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
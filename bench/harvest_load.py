@@ -0,0 +1,57 @@
+# end to end harvest against the local OAI-PMH stand-in server
+#
+#   python -m bench.harvest_load --records 20000 --sites 4 --workers 4 --latency 0.05
+#
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from amwmeta import xapian as amw
+from bench.oai_server import start_server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=5000, help="Records per site")
+    parser.add_argument("--sites", type=int, default=2)
+    parser.add_argument("--metadata-prefix", default="marc21", choices=[ "marc21", "oai_dc" ])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--per-host", type=int, default=amw.HARVEST_PER_HOST)
+    parser.add_argument("--commit-every", type=int, default=amw.HARVEST_COMMIT_EVERY)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, endpoints = start_server(records=args.records, sites=args.sites,
+                                     latency=args.latency, error_rate=args.error_rate,
+                                     page_size=args.page_size)
+    workdir = tempfile.mkdtemp(prefix='harvest-load-')
+    path = str(Path(workdir).joinpath('db'))
+    jobs = [ (endpoint, { "url": endpoint, "metadataPrefix": args.metadata_prefix })
+             for endpoint in endpoints ]
+    try:
+        start = time.perf_counter()
+        results = amw.harvest_sites(jobs, path=path,
+                                    workers=args.workers,
+                                    per_host=args.per_host,
+                                    commit_every=args.commit_every)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    total = sum(r['indexed'] + r['deleted'] for r in results.values())
+    print(json.dumps({
+        "records": total,
+        "seconds": elapsed,
+        "records_per_second": total / elapsed if elapsed else None,
+        "requests": server.requests,
+        "completed": all(r['completed'] for r in results.values()),
+        "parse_seconds": sum(r['parse_time'] for r in results.values()),
+        "commits": max(r['commits'] for r in results.values()),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# micro-benchmark of the MARC21 extraction
+#
+#   python -m bench.marc_extract --records 500 --rounds 5
+#
+import argparse
+import json
+import time
+from lxml import etree
+from amwmeta.xapian import MarcXMLRecord, MARC21_SPECS, OAI_NAMESPACE
+from bench.synthetic import fake_records, list_records_page
+from io import BytesIO
+
+def legacy_get_metadata(rec):
+    """The former MarcXMLRecord.get_metadata(), a findall per spec"""
+    ns = { None: 'http://www.loc.gov/MARC21/slim' }
+    out = {}
+    for node in rec.xml.findall('.//' + rec._oai_namespace + 'metadata'):
+        for spec in MARC21_SPECS:
+            target, tag, codes = spec
+            if not target in out:
+                out[target] = []
+            for el in node.findall('.//datafield[@tag="{0}"]'.format(tag), namespaces=ns):
+                values = []
+                for code in codes:
+                    values.extend([ sf.text for sf in el.findall('.//subfield[@code="{0}"]'.format(code),
+                                                                 namespaces=ns) ])
+                if len(values):
+                    out[target].extend([' '.join(values)])
+        break
+    return out
+
+def iterparse_marc_records(source):
+    """Stream the records of a MARC21 ListRecords page.
+
+    Each element is cleared once its record has been yielded, so the
+    metadata is parsed beforehand and the record's xml is not usable
+    afterwards. The harvest gets the pages parsed by sickle, this only
+    measures what streaming them would save.
+    """
+    for event, element in etree.iterparse(source, events=('end',),
+                                          tag=OAI_NAMESPACE + 'record'):
+        rec = MarcXMLRecord(element)
+        rec.metadata
+        yield rec
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+def timed(rounds, function):
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    page = list_records_page(fake_records(args.records), 'marc21')
+    tree = etree.fromstring(page)
+    records = [ MarcXMLRecord(el) for el in tree.iter(OAI_NAMESPACE + 'record') ]
+    for rec in records:
+        if not rec.deleted:
+            assert legacy_get_metadata(rec) == rec.get_metadata(), rec.header.identifier
+
+    legacy = timed(args.rounds, lambda: [ legacy_get_metadata(r) for r in records ])
+    compiled = timed(args.rounds, lambda: [ r.get_metadata() for r in records ])
+    streamed = timed(args.rounds, lambda: list(iterparse_marc_records(BytesIO(page))))
+    result = {
+        "records": len(records),
+        "page_bytes": len(page),
+        "legacy_per_record_us": legacy / len(records) * 1e6,
+        "compiled_per_record_us": compiled / len(records) * 1e6,
+        "iterparse_page_per_record_us": streamed / len(records) * 1e6,
+        "speedup": legacy / compiled,
+    }
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
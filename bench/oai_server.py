@@ -0,0 +1,273 @@
+# OAI-PMH stand-in server for load-testing the harvest
+#
+#   python -m bench.oai_server --records 100000 --sites 4 --latency 0.05
+#
+# Each site is served at http://127.0.0.1:<port>/site-<n>/oai-pmh and
+# answers ListRecords for oai_dc and marc21, with resumption tokens,
+# deleted records and from/until/set filtering. --latency and
+# --error-rate inject delays and 503 (with Retry-After) or 500 errors.
+# Responses are gzipped for the clients accepting it.
+import argparse
+import gzip
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from bench.synthetic import fake_record, record_xml
+
+EPOCH = datetime(2023, 1, 1, tzinfo=timezone.utc)
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+FORMATS = {
+    "oai_dc": ("http://www.openarchives.org/OAI/2.0/oai_dc.xsd",
+               "http://www.openarchives.org/OAI/2.0/oai_dc/"),
+    "marc21": ("http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd",
+               "http://www.loc.gov/MARC21/slim"),
+}
+
+class FakeRepository:
+    """Deterministic records of one site: record n is stamped n minutes
+    after EPOCH and belongs to set-(n % sets)"""
+    def __init__(self, name, records, seed=1, sets=3, page_size=100):
+        self.name = name
+        self.records = records
+        self.seed = seed
+        self.sets = sets
+        self.page_size = page_size
+
+    def datestamp(self, number):
+        return EPOCH + timedelta(minutes=number)
+
+    def set_spec(self, number):
+        return "set-" + str(number % self.sets)
+
+    def record(self, number):
+        rnd = random.Random("{0}:{1}:{2}".format(self.name, self.seed, number))
+        return fake_record(rnd, number, hostname=self.name)
+
+    def matching(self, start, date_from=None, date_until=None, set_spec=None):
+        # datestamps grow with the record number, so the date range is
+        # a range of numbers too
+        first = 0
+        last = self.records
+        if date_from:
+            first = max(first, -(-int((date_from - EPOCH).total_seconds()) // 60))
+        if date_until:
+            last = min(last, int((date_until - EPOCH).total_seconds()) // 60 + 1)
+        number = max(first, start)
+        while number < last:
+            if set_spec is None or self.set_spec(number) == set_spec:
+                yield number
+            number += 1
+
+
+class OAIError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+
+def parse_date(value):
+    if value is None:
+        return None
+    for date_format in (DATE_FORMAT, '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    raise OAIError("badArgument", "Invalid date " + value)
+
+def list_records(repository, params):
+    token = params.get('resumptionToken')
+    if token:
+        # offset|metadataPrefix|from|until|set
+        try:
+            offset, prefix, date_from, date_until, set_spec = token.split('|')
+            offset = int(offset)
+        except ValueError:
+            raise OAIError("badResumptionToken", "Invalid token " + token)
+    else:
+        offset = 0
+        prefix = params.get('metadataPrefix')
+        date_from = params.get('from') or ''
+        date_until = params.get('until') or ''
+        set_spec = params.get('set') or ''
+    if prefix not in FORMATS:
+        raise OAIError("cannotDisseminateFormat", "Unsupported format " + str(prefix))
+
+    numbers = repository.matching(offset, parse_date(date_from or None),
+                                  parse_date(date_until or None), set_spec or None)
+    page = []
+    next_offset = None
+    for number in numbers:
+        if len(page) == repository.page_size:
+            next_offset = number
+            break
+        page.append(number)
+    if not page:
+        raise OAIError("noRecordsMatch", "No records")
+
+    out = []
+    for number in page:
+        out.append(record_xml(repository.record(number), prefix,
+                              datestamp=repository.datestamp(number).strftime(DATE_FORMAT),
+                              sets=[ repository.set_spec(number) ]))
+    if next_offset is not None:
+        token = '|'.join([ str(next_offset), prefix, date_from, date_until, set_spec ])
+        out.append('<resumptionToken cursor="{0}">{1}</resumptionToken>'.format(offset,
+                                                                             escape(token)))
+    else:
+        # last page: empty token
+        out.append('<resumptionToken cursor="{0}"/>'.format(offset))
+    return '<ListRecords>' + ''.join(out) + '</ListRecords>'
+
+def page_offset(params):
+    """The number of the first record of the ListRecords page requested"""
+    try:
+        return int(params.get('resumptionToken', '0').split('|')[0])
+    except ValueError:
+        return 0
+
+
+def identify(repository, base_url):
+    return ('<Identify><repositoryName>{0}</repositoryName>'
+            '<baseURL>{1}</baseURL><protocolVersion>2.0</protocolVersion>'
+            '<earliestDatestamp>{2}</earliestDatestamp><deletedRecord>persistent</deletedRecord>'
+            '<granularity>YYYY-MM-DDThh:mm:ssZ</granularity></Identify>').format(escape(repository.name),
+                                                                                 escape(base_url),
+                                                                                 EPOCH.strftime(DATE_FORMAT))
+
+def oai_response(verb, params, base_url, body):
+    attributes = ''.join(' {0}="{1}"'.format(k, escape(v, { '"': '&quot;' }))
+                         for k, v in params.items() if k != 'verb')
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+            '<responseDate>{0}</responseDate>'
+            '<request verb="{1}"{2}>{3}</request>{4}</OAI-PMH>').format(
+                datetime.now(timezone.utc).strftime(DATE_FORMAT),
+                escape(verb or ''), attributes, escape(base_url), body).encode('utf-8')
+
+
+class OAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type="text/xml; charset=utf-8", headers=None):
+        headers = dict(headers or {})
+        if self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        repository = None
+        if len(parts) == 2 and parts[1] == 'oai-pmh':
+            repository = server.repositories.get(parts[0])
+        if repository is None:
+            self.send_body(404, b"Not found", "text/plain")
+            return
+
+        if server.latency:
+            time.sleep(server.latency * (0.5 + server.random.random()))
+        roll = server.random.random()
+        if roll < server.error_rate / 2:
+            self.send_body(503, b"Try later", "text/plain", { "Retry-After": "1" })
+            return
+        elif roll < server.error_rate:
+            self.send_body(500, b"Internal error", "text/plain")
+            return
+
+        params = { k: v[0] for k, v in parse_qs(url.query).items() }
+        verb = params.get('verb')
+        # a repository going down in the middle of a harvest
+        if server.fail_from is not None and verb == 'ListRecords' \
+           and page_offset(params) >= server.fail_from:
+            self.send_body(500, b"Internal error", "text/plain")
+            return
+        base_url = "http://{0}:{1}{2}".format(*server.server_address[:2], url.path)
+        try:
+            if verb == 'ListRecords':
+                body = list_records(repository, params)
+            elif verb == 'Identify':
+                body = identify(repository, base_url)
+            else:
+                raise OAIError("badVerb", "Unsupported verb " + str(verb))
+        except OAIError as e:
+            body = '<error code="{0}">{1}</error>'.format(e.code, escape(e.message))
+        with server.lock:
+            server.requests += 1
+        self.send_body(200, oai_response(verb, params, base_url, body))
+
+
+def start_server(records=1000, sites=1, port=0, latency=0.0, error_rate=0.0,
+                 page_size=100, seed=1, compress=True, verbose=False, fail_from=None):
+    """Start the server in a background thread. Returns the server and
+    the list of the OAI-PMH endpoints, one per site. The pages starting
+    at record fail_from or later fail until server.fail_from is unset."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), OAIHandler)
+    server.daemon_threads = True
+    server.repositories = {}
+    for number in range(sites):
+        name = "site-" + str(number)
+        server.repositories[name] = FakeRepository(name, records, seed=seed, page_size=page_size)
+    server.latency = latency
+    server.error_rate = error_rate
+    server.fail_from = fail_from
+    server.random = random.Random(seed)
+    server.compress = compress
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    endpoints = [ "http://{0}:{1}/{2}/oai-pmh".format(host, port, name)
+                  for name in server.repositories ]
+    return server, endpoints
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--records", type=int, default=1000, help="Records per site")
+    parser.add_argument("--sites", type=int, default=1)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Average seconds of delay of each response")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of the requests failing with 503 or 500")
+    parser.add_argument("--fail-from", type=int, default=None,
+                        help="Fail the pages starting at this record or later")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-compress", action="store_true",
+                        help="Ignore the Accept-Encoding of the clients")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    server, endpoints = start_server(records=args.records, sites=args.sites, port=args.port,
+                                     latency=args.latency, error_rate=args.error_rate,
+                                     page_size=args.page_size, seed=args.seed,
+                                     compress=not args.no_compress, verbose=args.verbose,
+                                     fail_from=args.fail_from)
+    for endpoint in endpoints:
+        print(endpoint)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# benchmarks of the harvest and search hot paths
+#
+#   python -m bench.run --sizes 10000,100000 --output bench.json
+#   python -m bench.compare old.json new.json
+#
+# The indexes are built from synthetic ListRecords pages, parsed and
+# indexed by the same code as the harvest (without the network), and
+# kept in --workdir so the query benchmarks can be repeated.
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from lxml import etree
+import xapian
+from django.utils.datastructures import MultiValueDict
+from amwmeta import xapian as amw
+from amwmeta.utils import DataPage, paginator
+from bench.synthetic import fake_records, list_records_page, WORDS, LANGUAGES
+
+HOSTNAMES = [ "a.example.org", "b.example.org", "c.example.org", "d.example.org" ]
+PAGE_SIZE = 100
+
+def percentiles(timings):
+    timings = sorted(timings)
+    def at(fraction):
+        return timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000
+    return {
+        "count": len(timings),
+        "p50_ms": at(0.50),
+        "p90_ms": at(0.90),
+        "p99_ms": at(0.99),
+        "max_ms": timings[-1] * 1000,
+    }
+
+def synthetic_pages(size, metadata_prefix, hostname, seed):
+    records = list(fake_records(size, seed=seed, hostname=hostname))
+    for start in range(0, len(records), PAGE_SIZE):
+        yield list_records_page(records[start:start + PAGE_SIZE], metadata_prefix)
+
+def page_records(pages, record_class):
+    for page in pages:
+        tree = etree.fromstring(page)
+        for element in tree.iter(amw.OAI_NAMESPACE + 'record'):
+            yield None, record_class(element)
+
+def build_index(path, size, commit_every):
+    """Index size synthetic records, half MARC21 and half Dublin Core,
+    spread over HOSTNAMES. Returns the harvest throughput."""
+    db = amw.open_index(path)
+    writer = amw.IndexWriter(db, commit_every=commit_every)
+    termgenerator = xapian.TermGenerator()
+    termgenerator.set_stemmer(xapian.Stem("none"))
+    result = {}
+    per_host = size // len(HOSTNAMES)
+    for metadata_prefix, record_class in (('marc21', amw.MarcXMLRecord),
+                                          ('oai_dc', amw.HarvestRecord)):
+        stats = amw.harvest_stats()
+        start = time.perf_counter()
+        for number, hostname in enumerate(HOSTNAMES):
+            count = per_host // 2
+            pages = synthetic_pages(count, metadata_prefix, hostname + '.' + metadata_prefix,
+                                    seed=number)
+            records = page_records(pages, record_class)
+            parsed = amw.parse_records(records, hostname, stats)
+            for page_token, idterm, doc in amw.build_documents(parsed, termgenerator):
+                writer.write('bench', page_token, idterm, doc, stats)
+        writer.commit()
+        elapsed = time.perf_counter() - start
+        total = stats['indexed'] + stats['deleted']
+        result[metadata_prefix] = {
+            "records": total,
+            "seconds": elapsed,
+            "records_per_second": total / elapsed if elapsed else None,
+            "parse_seconds": stats['parse_time'],
+        }
+    db.close()
+    return result
+
+def query_shapes(rnd, last_page):
+    word = rnd.choice(WORDS)
+    return {
+        "match_all": {},
+        "free_text": { "query": [ word ] },
+        "free_text_two_terms": { "query": [ word + " " + rnd.choice(WORDS) ] },
+        "phrase": { "query": [ '"' + word + " " + rnd.choice(WORDS) + '"' ] },
+        "facet_filter": { "filter_language": [ amw.iso_lang_code(rnd.choice(LANGUAGES)) ] },
+        "text_and_facets": { "query": [ word ],
+                             "filter_hostname": [ rnd.choice(HOSTNAMES) ],
+                             "filter_subject": [ rnd.choice(WORDS) ] },
+        "deep_page": { "page_number": [ str(rnd.randint(max(1, last_page // 2), max(1, last_page))) ] },
+    }
+
+def bench_queries(path, rounds, seed, facet_sample_size):
+    readers = amw.ReaderPool(path)
+    db, queryparser = readers.get()
+    last_page = max(1, db.get_doccount() // 10)
+    rnd = random.Random(seed)
+    timings = {}
+    for i in range(rounds):
+        for shape, params in query_shapes(rnd, last_page).items():
+            params = MultiValueDict(params)
+            start = time.perf_counter()
+            # no offset cap, so deep_page really reaches the deep pages
+            # and stays comparable with runs before the cap
+            amw.search(params, facet_sample_size=facet_sample_size, readers=readers,
+                       max_offset=None)
+            timings.setdefault(shape, []).append(time.perf_counter() - start)
+    out = { shape: percentiles(timings[shape]) for shape in timings }
+    out['reader_stats'] = readers.stats()
+    return out
+
+def bench_paginator(total_entries, rounds):
+    params = MultiValueDict({ "query": [ "library" ], "filter_language": [ "en" ] })
+    timings = []
+    for i in range(rounds):
+        pager = DataPage(total_entries=total_entries, entries_per_page=10,
+                         current_page=total_entries // 20 or 1)
+        start = time.perf_counter()
+        paginator(pager, "/search/", params)
+        timings.append(time.perf_counter() - start)
+    return percentiles(timings)
+
+def git_revision():
+    try:
+        return subprocess.run([ "git", "rev-parse", "HEAD" ], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="Comma separated index sizes, e.g. 10000,100000,1000000")
+    parser.add_argument("--workdir", default=str(Path(__file__).resolve().parent.parent.joinpath('xapian', 'bench')))
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild existing indexes")
+    parser.add_argument("--rounds", type=int, default=50, help="Runs of each query shape")
+    parser.add_argument("--commit-every", type=int, default=amw.HARVEST_COMMIT_EVERY)
+    parser.add_argument("--facet-sample-size", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "xapian": xapian.version_string(),
+        "started": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "sizes": {},
+    }
+    for size in [ int(s) for s in args.sizes.split(',') ]:
+        path = os.path.join(args.workdir, 'db-' + str(size))
+        out = {}
+        if args.rebuild or not os.path.exists(path):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            out['harvest'] = build_index(path, size, args.commit_every)
+        out['queries'] = bench_queries(path, args.rounds, args.seed, args.facet_sample_size)
+        out['paginator'] = bench_paginator(size, args.rounds)
+        results['sizes'][str(size)] = out
+
+    dump = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(dump + "\n")
+    else:
+        print(dump)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# synthetic OAI-PMH payloads for the benchmarks
+import random
+from xml.sax.saxutils import escape
+
+WORDS = """anarchy mutual aid commune federation library freedom worker
+struggle history theory practice society ecology city land bread
+press union strike school prison border memory war peace""".split()
+
+LANGUAGES = [ 'eng', 'ita', 'spa', 'fra', 'deu', 'hrv', 'por', 'fin' ]
+
+def words(rnd, count):
+    return ' '.join(rnd.choice(WORDS) for i in range(count))
+
+def fake_record(rnd, number, hostname="example.org"):
+    return {
+        "identifier": "oai:{0}:text-{1}".format(hostname, number),
+        "url": "https://{0}/library/text-{1}".format(hostname, number),
+        "title": words(rnd, rnd.randint(2, 7)).title(),
+        "subtitle": words(rnd, rnd.randint(0, 5)),
+        "creators": [ words(rnd, 2).title() for i in range(rnd.randint(1, 3)) ],
+        "subjects": [ rnd.choice(WORDS) for i in range(rnd.randint(0, 6)) ],
+        "date": str(rnd.randint(1850, 2023)),
+        "language": rnd.choice(LANGUAGES),
+        "description": words(rnd, rnd.randint(20, 120)),
+        "deleted": rnd.random() < 0.02,
+    }
+
+def _datafield(tag, subfields):
+    out = [ '<datafield tag="{0}" ind1=" " ind2=" ">'.format(tag) ]
+    for code, value in subfields:
+        if value:
+            out.append('<subfield code="{0}">{1}</subfield>'.format(code, escape(value)))
+    out.append('</datafield>')
+    return ''.join(out)
+
+def marc21_metadata(rec):
+    fields = [ _datafield('041', [('a', rec['language'])]) ]
+    fields.append(_datafield('100', [('a', rec['creators'][0])]))
+    fields.append(_datafield('245', [('a', rec['title']), ('b', rec['subtitle'])]))
+    fields.append(_datafield('260', [('b', 'The Anarchist Library'), ('c', rec['date'])]))
+    fields.append(_datafield('300', [('a', '42 pages'), ('b', 'illustrations'), ('e', 'PDF')]))
+    fields.append(_datafield('336', [('a', 'text')]))
+    fields.append(_datafield('363', [('i', rec['date'])]))
+    fields.append(_datafield('520', [('a', rec['description'])]))
+    fields.append(_datafield('540', [('a', 'Public domain')]))
+    fields.append(_datafield('546', [('a', rec['language'])]))
+    for subject in rec['subjects']:
+        fields.append(_datafield('653', [('a', subject)]))
+    for creator in rec['creators']:
+        fields.append(_datafield('720', [('a', creator), ('e', 'author')]))
+    fields.append(_datafield('856', [('u', rec['url']), ('q', 'text/html')]))
+    fields.append(_datafield('856', [('u', rec['url'] + '.epub'), ('q', 'application/epub+zip')]))
+    return ('<record xmlns="http://www.loc.gov/MARC21/slim">'
+            '<leader>00000nam a2200000 a 4500</leader>'
+            + ''.join(fields) + '</record>')
+
+def oai_dc_metadata(rec):
+    out = [ '<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/">' ]
+    values = [ ('title', rec['title']), ('date', rec['date']),
+               ('language', rec['language']), ('description', rec['description']),
+               ('identifier', rec['url']) ]
+    values.extend(('creator', c) for c in rec['creators'])
+    values.extend(('subject', s) for s in rec['subjects'])
+    for name, value in values:
+        out.append('<dc:{0}>{1}</dc:{0}>'.format(name, escape(value)))
+    out.append('</oai_dc:dc>')
+    return ''.join(out)
+
+def record_xml(rec, metadata_prefix, datestamp="2023-06-01T00:00:00Z", sets=()):
+    header = [ '<header{0}>'.format(' status="deleted"' if rec['deleted'] else '') ]
+    header.append('<identifier>{0}</identifier>'.format(escape(rec['identifier'])))
+    header.append('<datestamp>{0}</datestamp>'.format(datestamp))
+    for spec in sets:
+        header.append('<setSpec>{0}</setSpec>'.format(escape(spec)))
+    header.append('</header>')
+    if rec['deleted']:
+        return '<record>' + ''.join(header) + '</record>'
+    if metadata_prefix == 'marc21':
+        metadata = marc21_metadata(rec)
+    else:
+        metadata = oai_dc_metadata(rec)
+    return '<record>' + ''.join(header) + '<metadata>' + metadata + '</metadata></record>'
+
+def list_records_page(records, metadata_prefix='marc21', resumption_token=None,
+                      base_url="http://localhost/oai-pmh"):
+    out = [ '<?xml version="1.0" encoding="UTF-8"?>',
+            '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">',
+            '<responseDate>2023-06-01T00:00:00Z</responseDate>',
+            '<request verb="ListRecords" metadataPrefix="{0}">{1}</request>'.format(metadata_prefix,
+                                                                                  escape(base_url)),
+            '<ListRecords>' ]
+    for rec in records:
+        out.append(record_xml(rec, metadata_prefix))
+    if resumption_token is not None:
+        out.append('<resumptionToken>{0}</resumptionToken>'.format(escape(resumption_token)))
+    out.append('</ListRecords></OAI-PMH>')
+    return '\n'.join(out).encode('utf-8')
+
+def fake_records(count, seed=1, hostname="example.org"):
+    rnd = random.Random(seed)
+    for number in range(count):
+        yield fake_record(rnd, number, hostname=hostname)
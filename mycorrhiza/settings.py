@@ -129,6 +129,58 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Maximum number of documents examined to compute the facets of a
+# search. None means all the matching documents.
+FACET_SAMPLE_SIZE = None
+
+# Keep one Xapian database per site in xapian/shards, harvested and
+# rebuilt independently, and search them together through
+# xapian/shards.stub. Otherwise everything goes into xapian/db.
+XAPIAN_SHARDS = False
+
+# Values shown for each facet, the most common first. The others can be
+# paged with search/api/facet. None shows all of them.
+FACET_LIMIT = 20
+
+# Deepest result reachable by page number. Further results need the
+# cursor mode (sort by date or title, with the "after" parameter).
+SEARCH_MAX_OFFSET = 10000
+
+# Show a single result for the copies of a text harvested from several
+# sites, with links to the others. Copies share the title, creators and
+# languages, or an identifier (anonymous texts only the identifier).
+SEARCH_COLLAPSE = True
+
+# Cache of the search results: "local" (per process), "django" (the
+# SEARCH_CACHE_ALIAS cache of CACHES, shared by the workers) or None.
+# Entries are invalidated by every commit to the index.
+SEARCH_CACHE = "local"
+SEARCH_CACHE_ALIAS = "default"
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 300
+
+# Searches taking longer than this many seconds (including the
+# rendering) are logged by the search.views.slow logger. None disables
+# the log.
+SLOW_QUERY_THRESHOLD = 1.0
+
+# Send the time spent in each phase of a search in the Server-Timing
+# response header
+SEARCH_SERVER_TIMING = DEBUG
+
+# Under ASGI, serve the search views from an async wrapper running them
+# in a pool of SEARCH_WORKERS threads. At most SEARCH_MAX_PENDING
+# searches are accepted at once, the others get a 503. Searches taking
+# more than SEARCH_TIMEOUT seconds get a 504.
+SEARCH_ASYNC = False
+SEARCH_WORKERS = 4
+SEARCH_MAX_PENDING = 16
+SEARCH_TIMEOUT = 10
+
+# Clients allowed to read the counters of search/metrics, besides the
+# logged in staff users. The endpoint is closed to everybody else.
+SEARCH_METRICS_ALLOWED_IPS = []
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -2,7 +2,32 @@ from django.contrib import admin
 
 from .models import Site, Harvest
 
-admin.site.register(Site)
-admin.site.register(Harvest)
+class HarvestInline(admin.TabularInline):
+    model = Harvest
+    extra = 0
+    can_delete = False
+    show_change_link = True
+    fields = ['datetime', 'completed', 'records_fetched', 'records_indexed', 'records_deleted',
+              'bytes_transferred', 'fetch_seconds', 'parse_seconds', 'index_seconds',
+              'duration_seconds', 'records_per_second']
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+@admin.register(Site)
+class SiteAdmin(admin.ModelAdmin):
+    list_display = ['title', 'url', 'oai_metadata_format', 'last_harvested',
+                    'average_records_per_second', 'average_bytes_per_record']
+    inlines = [ HarvestInline ]
+
+@admin.register(Harvest)
+class HarvestAdmin(admin.ModelAdmin):
+    list_display = ['site', 'datetime', 'completed', 'records_fetched', 'records_indexed',
+                    'records_deleted', 'bytes_transferred', 'fetch_seconds', 'parse_seconds',
+                    'index_seconds', 'duration_seconds', 'records_per_second', 'bytes_per_record',
+                    'commits']
+    list_filter = ['site', 'completed']
+    date_hierarchy = 'datetime'
 
 # Register your models here.
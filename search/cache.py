@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.cache import caches
+from amwmeta.xapian import ResultCache
+
+class DjangoResultCache:
+    """search() result cache on top of a Django cache, shared by the workers"""
+    def __init__(self, alias="default", ttl=300):
+        self.alias = alias
+        self.ttl = ttl
+
+    def get(self, key):
+        return caches[self.alias].get(key)
+
+    def set(self, key, value):
+        caches[self.alias].set(key, value, self.ttl)
+
+
+def get_result_cache():
+    backend = settings.SEARCH_CACHE
+    if backend == "local":
+        return ResultCache(max_entries=settings.SEARCH_CACHE_SIZE,
+                           ttl=settings.SEARCH_CACHE_TTL)
+    elif backend == "django":
+        return DjangoResultCache(alias=settings.SEARCH_CACHE_ALIAS,
+                                 ttl=settings.SEARCH_CACHE_TTL)
+    return None
@@ -1,29 +1,38 @@
 from django.core.management.base import BaseCommand, CommandError
-from amwmeta.xapian import harvest, XAPIAN_DB
+from amwmeta.xapian import harvest_sites, rebuild_index, harvest_shards, XAPIAN_DB, XAPIAN_SHARDS_DIR, HARVEST_COMMIT_EVERY, HARVEST_COMMIT_INTERVAL, HARVEST_PER_HOST
 from search.models import Site, Harvest
+from django.conf import settings
 from datetime import datetime, timezone
-import shutil
 
 class Command(BaseCommand):
     help = "Harvest the sites"
     def add_arguments(self, parser):
         parser.add_argument("--force",
                             action="store_true", # boolean
-                            help="Force a full harvest")
+                            help="Force a full harvest, rebuilding the index next to the current one")
+        parser.add_argument("--commit-every",
+                            type=int,
+                            default=HARVEST_COMMIT_EVERY,
+                            help="Commit every N documents")
+        parser.add_argument("--commit-interval",
+                            type=int,
+                            default=HARVEST_COMMIT_INTERVAL,
+                            help="Commit at least every N seconds")
+        parser.add_argument("--workers",
+                            type=int,
+                            default=1,
+                            help="Harvest up to N sites at once")
+        parser.add_argument("--per-host",
+                            type=int,
+                            default=HARVEST_PER_HOST,
+                            help="Harvest up to N sites of the same host at once")
 
     def handle(self, *args, **options):
-        forcing = False
-        if options['force']:
-            forcing = True
-            try:
-                print("Removing " + XAPIAN_DB)
-                shutil.rmtree(XAPIAN_DB)
-            except FileNotFoundError:
-                pass
-
-
+        forcing = options['force']
+        sites = {}
+        started = {}
+        jobs = []
         for site in Site.objects.all():
-            now = datetime.now(timezone.utc)
             opts = {
                 "url": site.url,
                 "metadataPrefix": site.oai_metadata_format,
@@ -36,11 +45,70 @@ class Command(BaseCommand):
             if site.oai_set:
                 opts['set'] = site.oai_set
 
-            logs = harvest(**opts)
-            if logs:
-                msg = "Total indexed: " + str(len(logs))
-                print(msg)
-                logs.append(msg)
+            sites[site.id] = site
+            started[site.id] = datetime.now(timezone.utc)
+            jobs.append((site.id, opts))
+
+        def site_done(site_id, stats):
+            site = sites[site_id]
+            now = started[site_id]
+            index_seconds = stats['build_time'] + stats['write_time']
+            summary = ("{0}: fetched: {1}, indexed: {2}, removed: {3}, {4} bytes in {5} requests "
+                       "({11} retries), fetch: {6:.2f}s, parse: {7:.2f}s, index: {8:.2f}s, "
+                       "total: {9:.2f}s, commits: {10}").format(site.title,
+                                               stats['fetched'],
+                                               stats['indexed'],
+                                               stats['deleted'],
+                                               stats['bytes'],
+                                               stats['requests'],
+                                               stats['fetch_time'],
+                                               stats['parse_time'],
+                                               index_seconds,
+                                               stats['duration'],
+                                               stats['commits'],
+                                               stats['retries'])
+            print(summary)
+            logs = [ summary ]
+            if stats['duplicate_of'] is not None:
+                logs.append("Same records as " + sites[stats['duplicate_of']].title + ", harvested with it")
+            if stats['completed']:
                 site.last_harvested = now
                 site.save()
-                site.harvest_set.create(datetime=now, logs="\n".join(logs))
+            else:
+                logs.append("Incomplete harvest, the next run resumes from the last commit")
+            logs.extend("Error: " + e for e in stats['errors'])
+            logs.extend(stats['logs'])
+            if stats['fetched'] or not stats['completed'] or stats['duplicate_of'] is not None:
+                site.harvest_set.create(datetime=now,
+                                        logs="\n".join(logs),
+                                        completed=stats['completed'],
+                                        records_fetched=stats['fetched'],
+                                        records_indexed=stats['indexed'],
+                                        records_deleted=stats['deleted'],
+                                        requests=stats['requests'],
+                                        bytes_transferred=stats['bytes'],
+                                        fetch_seconds=stats['fetch_time'],
+                                        parse_seconds=stats['parse_time'],
+                                        index_seconds=index_seconds,
+                                        duration_seconds=stats['duration'],
+                                        commits=stats['commits'])
+
+        harvest_opts = {
+            "workers": options['workers'],
+            "per_host": options['per_host'],
+            "commit_every": options['commit_every'],
+            "commit_interval": options['commit_interval'],
+        }
+        if settings.XAPIAN_SHARDS:
+            # a site is marked as harvested only if its own shard went live
+            print("Harvesting into the shards of " + XAPIAN_SHARDS_DIR)
+            harvest_shards(jobs, force=forcing, on_done=site_done, **harvest_opts)
+        elif forcing:
+            print("Rebuilding " + XAPIAN_DB)
+            results = rebuild_index(jobs, **harvest_opts)
+            # the sites are marked as harvested only if the new index
+            # went live, the others are logged as incomplete
+            for site_id in results:
+                site_done(site_id, results[site_id])
+        else:
+            harvest_sites(jobs, on_done=site_done, **harvest_opts)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from amwmeta.xapian import remap_language_terms, index_paths
+
+class Command(BaseCommand):
+    help = "Normalize the language codes of the indexed documents without harvesting again"
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=1000,
+                            help="Commit every N documents")
+        parser.add_argument("--unindexed",
+                            action="store_true",
+                            help="Check the documents without any language code as well")
+
+    def handle(self, *args, **options):
+        for path in index_paths(settings.XAPIAN_SHARDS):
+            print("Remapping the language codes of " + path)
+            rewritten = remap_language_terms(path, batch_size=options['batch_size'],
+                                             unindexed=options['unindexed'])
+            if rewritten is None:
+                raise CommandError(path + " was not remapped")
+            print("Total remapped: " + str(rewritten))
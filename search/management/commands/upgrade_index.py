@@ -0,0 +1,25 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from amwmeta.xapian import upgrade_index, index_paths, build_shard_suggestions, SCHEMA_VERSION
+
+class Command(BaseCommand):
+    help = "Upgrade the Xapian index in place to the current layout"
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=1000,
+                            help="Commit every N documents")
+
+    def handle(self, *args, **options):
+        for path in index_paths(settings.XAPIAN_SHARDS):
+            if not os.path.isdir(path):
+                raise CommandError("There is no index at " + path)
+            print("Upgrading " + path + " to layout " + str(SCHEMA_VERSION))
+            converted = upgrade_index(path, batch_size=options['batch_size'])
+            if converted is None:
+                raise CommandError(path + " was not upgraded")
+            print("Total upgraded: " + str(converted))
+        if settings.XAPIAN_SHARDS:
+            print("Building the suggestions of the shards")
+            build_shard_suggestions()
@@ -0,0 +1,77 @@
+# Generated by Django 4.2.4 on 2026-10-17 15:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0003_remove_site_oai_prefix'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='harvest',
+            options={'ordering': ['-datetime']},
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='bytes_transferred',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='commits',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='completed',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='duration_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='fetch_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='index_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='parse_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='records_deleted',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='records_fetched',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='records_indexed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='harvest',
+            name='requests',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='harvest',
+            name='logs',
+            field=models.TextField(blank=True),
+        ),
+    ]
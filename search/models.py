@@ -19,6 +19,23 @@ class Site(models.Model):
     def __str__(self):
         return self.title
 
+    def recent_harvests(self, count=10):
+        return self.harvest_set.order_by('-datetime')[:count]
+
+    def average_records_per_second(self):
+        rates = [ h.records_per_second() for h in self.recent_harvests() ]
+        rates = [ r for r in rates if r is not None ]
+        if rates:
+            return round(sum(rates) / len(rates), 1)
+        return None
+
+    def average_bytes_per_record(self):
+        sizes = [ h.bytes_per_record() for h in self.recent_harvests() ]
+        sizes = [ s for s in sizes if s is not None ]
+        if sizes:
+            return int(sum(sizes) / len(sizes))
+        return None
+
     def last_harvested_zulu(self):
         dt = self.last_harvested
         if dt:
@@ -30,6 +47,32 @@ class Site(models.Model):
 class Harvest(models.Model):
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
     datetime = models.DateTimeField()
-    logs = models.TextField()
+    # summary, errors and last lines of the run
+    logs = models.TextField(blank=True)
+    completed = models.BooleanField(default=True)
+    records_fetched = models.PositiveIntegerField(default=0)
+    records_indexed = models.PositiveIntegerField(default=0)
+    records_deleted = models.PositiveIntegerField(default=0)
+    requests = models.PositiveIntegerField(default=0)
+    bytes_transferred = models.PositiveBigIntegerField(default=0)
+    fetch_seconds = models.FloatField(default=0)
+    parse_seconds = models.FloatField(default=0)
+    index_seconds = models.FloatField(default=0)
+    duration_seconds = models.FloatField(default=0)
+    commits = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-datetime']
+
     def __str__(self):
         return self.site.title + ' Harvest ' + self.datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def records_per_second(self):
+        if self.duration_seconds:
+            return round(self.records_fetched / self.duration_seconds, 1)
+        return None
+
+    def bytes_per_record(self):
+        if self.records_fetched:
+            return int(self.bytes_transferred / self.records_fetched)
+        return None
@@ -0,0 +1,77 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.http import HttpResponse
+from amwmeta.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+class SearchExecutor:
+    """Bounded pool of threads running the blocking search views.
+
+    The readers of amwmeta.xapian are per thread, so each worker thread
+    keeps its own open database across the requests it serves. At most
+    max_pending calls are admitted at once (running or waiting for a
+    thread); the others are refused at once instead of queueing.
+    """
+    def __init__(self, workers=4, max_pending=16):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="search")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def admit(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            return True
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    async def run(self, func):
+        """Run func in a thread. The caller must have been admitted."""
+        # in the context of the request, which holds the script prefix
+        # and the urlconf used by reverse()
+        future = self._executor.submit(contextvars.copy_context().run, func)
+        # the slot is freed when the call is over (or cancelled before
+        # starting), so calls abandoned by a timeout still count
+        # against max_pending while they run
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+
+SEARCH_EXECUTOR = SearchExecutor(workers=settings.SEARCH_WORKERS,
+                                 max_pending=settings.SEARCH_MAX_PENDING)
+
+def offloaded(view, executor=SEARCH_EXECUTOR):
+    """Async version of a synchronous view, run in the executor with
+    admission control and the SEARCH_TIMEOUT"""
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        view_name = view.__name__
+        if not executor.admit():
+            METRICS.inc('search_rejected_total', { "view": view_name })
+            response = HttpResponse("Too many searches in progress, please retry later",
+                                    status=503, content_type="text/plain")
+            response['Retry-After'] = 1
+            return response
+        try:
+            return await asyncio.wait_for(executor.run(functools.partial(view, request, *args, **kwargs)),
+                                          settings.SEARCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            METRICS.inc('search_timeouts_total', { "view": view_name })
+            logger.warning("Search timed out after {0}s: {1}".format(settings.SEARCH_TIMEOUT,
+                                                                    request.GET.urlencode()))
+            return HttpResponse("The search took too long", status=504, content_type="text/plain")
+    return async_view
@@ -1,3 +1,470 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+import time
+import xapian
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from django.http import QueryDict, Http404
+from django.test import SimpleTestCase, RequestFactory, override_settings
+from unittest import mock
+from search import views
+from amwmeta import xapian as amwmeta_xapian
+from bench.oai_server import start_server
+from amwmeta.xapian import (search, add_sort_values, build_queryparser, upgrade_database,
+                            record_fingerprint, assign_cluster, build_documents, CLUSTER_SLOT,
+                            FacetCache, HostScheduler, harvest_sites, IndexWriter, resumption_token_key,
+                            suggest, build_suggestions, add_suggest_terms, encode_facet_values,
+                            remap_database_languages, get_schema_version, language_codes,
+                            LANGUAGE_TABLE, FIELD_MAPPING, SCHEMA_VERSION, FACET_COUNTS)
 
 # Create your tests here.
+
+def memory_database():
+    return xapian.WritableDatabase('', xapian.DB_BACKEND_INMEMORY)
+
+def disk_database(testcase):
+    """A glass database removed after the test, for the metadata keys
+    which the in-memory backend can't list"""
+    tmp = tempfile.TemporaryDirectory()
+    testcase.addCleanup(tmp.cleanup)
+    testcase.db_path = os.path.join(tmp.name, 'db')
+    db = xapian.WritableDatabase(testcase.db_path, xapian.DB_CREATE_OR_OPEN)
+    testcase.addCleanup(db.close)
+    return db
+
+def index_record(db, oai_identifier, **record):
+    """Build the document of an OAI record as the harvest does and write
+    it with its cluster"""
+    rec = SimpleNamespace(header=SimpleNamespace(identifier=oai_identifier), deleted=False)
+    termgenerator = xapian.TermGenerator()
+    for page_token, idterm, doc in build_documents([ (None, rec, record) ], termgenerator):
+        assign_cluster(db, idterm, doc)
+        db.replace_document(idterm, doc)
+
+
+class MemoryReaders:
+    """Stand-in for ReaderPool over a database opened by the test"""
+    sharded = False
+
+    def __init__(self, db, path=None):
+        self.db = db
+        self.path = path
+        self.queryparser = build_queryparser(db)
+
+    def get(self):
+        return self.db, self.queryparser
+
+    def revision(self):
+        # in-memory databases have no revision. The tests clear
+        # FACET_COUNTS before searching a changed database.
+        return 'memory', id(self.db)
+
+
+class CursorPagingTest(SimpleTestCase):
+    def setUp(self):
+        FACET_COUNTS.clear()
+        db = memory_database()
+        self.expected = []
+        for n in range(1, 31):
+            doc = xapian.Document()
+            # a third of the records without a year, some without a title
+            dates = [ str(1900 + n % 7) ] if n % 3 else []
+            titles = [ "Title {0}".format(n % 5) ] if n % 4 else []
+            add_sort_values(doc, titles, dates)
+            identifier = "oai:test:{0}".format(n)
+            doc.set_data(json.dumps({ "oai_pmh_identifier": identifier }))
+            doc.add_boolean_term("Q" + identifier)
+            db.add_document(doc)
+            self.expected.append(identifier)
+        self.readers = MemoryReaders(db)
+
+    def walk(self, sort):
+        seen = []
+        after = ''
+        for page in range(100):
+            params = QueryDict(mutable=True)
+            params.update({ "sort": sort, "page_size": "4", "after": after })
+            context = search(params, readers=self.readers)
+            seen.extend(record['oai_pmh_identifier'] for record in context['matches'])
+            after = context['next_cursor']
+            if not after:
+                break
+        return seen
+
+    def test_page_size_is_capped(self):
+        params = QueryDict(mutable=True)
+        params.update({ "page_size": "1000000", "page_number": "2" })
+        with mock.patch('amwmeta.xapian.SEARCH_MAX_PAGE_SIZE', 8):
+            context = search(params, readers=self.readers)
+        self.assertEqual(context['pager'].entries_per_page, 8)
+        self.assertEqual(len(context['matches']), 8)
+
+    def test_untitled_records_sort_last(self):
+        params = QueryDict(mutable=True)
+        params.update({ "sort": "title", "page_size": "10" })
+        context = search(params, readers=self.readers)
+        numbers = [ int(record['oai_pmh_identifier'].rsplit(':', 1)[1]) for record in context['matches'] ]
+        self.assertEqual(len(numbers), 10)
+        self.assertTrue(all(n % 4 for n in numbers))
+
+    def test_date_cursor_reaches_the_records_without_a_year(self):
+        seen = self.walk('date')
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(sorted(seen), sorted(self.expected))
+
+    def test_title_cursor_reaches_every_untitled_record(self):
+        seen = self.walk('title')
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(sorted(seen), sorted(self.expected))
+
+
+class LayoutUpgradeTest(SimpleTestCase):
+    def setUp(self):
+        FACET_COUNTS.clear()
+        # an index built before the layout versions: JSON lists in the
+        # value slots and no schema_version
+        self.db = disk_database(self)
+        for identifier, language in (("oai:test:1", "fre"), ("oai:test:2", "Klingon")):
+            doc = xapian.Document()
+            record = { "oai_pmh_identifier": identifier, "title": [ "Le titre" ], "language": [ language ] }
+            doc.set_data(json.dumps(record))
+            doc.add_value(FIELD_MAPPING['title'][0], json.dumps(record['title']))
+            doc.add_value(FIELD_MAPPING['date'][0], json.dumps([ "1920" ]))
+            if language_codes(language):
+                doc.add_value(FIELD_MAPPING['language'][0], json.dumps([ language ]))
+                doc.add_boolean_term("L" + language)
+            doc.add_boolean_term("Q" + identifier)
+            self.db.add_document(doc)
+        self.db.commit()
+
+    def terms(self, docid):
+        return set(item.term.decode('utf-8') for item in self.db.get_document(docid).termlist())
+
+    def test_remap_refuses_an_old_layout(self):
+        self.assertIsNone(remap_database_languages(self.db))
+        self.assertEqual(get_schema_version(self.db), 1)
+        self.assertEqual(self.db.get_document(1).get_value(FIELD_MAPPING['language'][0]), b'["fre"]')
+
+    def test_upgrade_then_search(self):
+        self.assertEqual(upgrade_database(self.db), 2)
+        self.assertEqual(get_schema_version(self.db), SCHEMA_VERSION)
+        self.assertEqual(self.db.get_document(1).get_value(FIELD_MAPPING['language'][0]), b'fr')
+        self.assertIn("Lfr", self.terms(1))
+        self.assertNotIn("Lfre", self.terms(1))
+        self.assertEqual(upgrade_database(self.db), 0)
+        context = search(QueryDict(), readers=MemoryReaders(self.db))
+        languages = [ facet for facet in context['facets'] if facet['name'] == 'language' ]
+        self.assertEqual([ value['term'] for value in languages[0]['values'] ], [ 'fr' ])
+
+    def test_upgrade_refuses_a_newer_layout(self):
+        self.db.set_metadata('schema_version', str(SCHEMA_VERSION + 1))
+        self.assertIsNone(upgrade_database(self.db))
+        self.assertEqual(self.db.get_document(1).get_value(FIELD_MAPPING['language'][0]), b'["fre"]')
+
+    def test_remap_reaches_the_unindexed_documents(self):
+        upgrade_database(self.db)
+        self.addCleanup(language_codes.cache_clear)
+        with mock.patch.dict(LANGUAGE_TABLE, { "klingon": "tlh" }):
+            language_codes.cache_clear()
+            self.assertEqual(remap_database_languages(self.db), 0)
+            self.assertEqual(remap_database_languages(self.db, unindexed=True), 1)
+        self.assertIn("Ltlh", self.terms(2))
+        self.assertEqual(self.db.get_document(2).get_value(FIELD_MAPPING['language'][0]), b'tlh')
+
+
+class SuggestionTest(SimpleTestCase):
+    def setUp(self):
+        self.db = disk_database(self)
+        creators = [ "Abcd A", "Abcd B", "Abcd C", "Abcd D" ] + [ "Abcd Z" ] * 5
+        for creator in creators:
+            doc = xapian.Document()
+            add_suggest_terms(doc, { "creator": [ creator ] })
+            self.db.add_document(doc)
+        self.readers = MemoryReaders(self.db)
+
+    def test_dense_prefixes_are_ranked_by_documents(self):
+        with mock.patch('amwmeta.xapian.SUGGEST_MAX_SCAN', 3):
+            build_suggestions(self.db)
+            suggestions = suggest('creator', 'abcd', limit=2, readers=self.readers)
+        self.assertEqual(suggestions, [ { "value": "Abcd Z", "count": 5 },
+                                        { "value": "Abcd A", "count": 1 } ])
+
+    def test_limit_above_the_default(self):
+        build_suggestions(self.db)
+        self.assertEqual(len(suggest('creator', 'ab', limit=20, readers=self.readers)), 5)
+
+
+class ExpandFacetTest(SimpleTestCase):
+    def setUp(self):
+        FACET_COUNTS.clear()
+        db = memory_database()
+        db.set_metadata('schema_version', str(SCHEMA_VERSION))
+        slot, prefix, is_boolean = FIELD_MAPPING['subject']
+        for n in range(30):
+            doc = xapian.Document()
+            subject = "Subject {0}".format(n)
+            doc.add_value(slot, encode_facet_values([ subject ]))
+            doc.add_boolean_term(prefix + subject.lower())
+            doc.set_data(json.dumps({ "oai_pmh_identifier": "oai:test:{0}".format(n) }))
+            db.add_document(doc)
+        self.readers = MemoryReaders(db)
+
+    def subject_facet(self, querystring):
+        context = search(QueryDict(querystring), readers=self.readers, facet_limit=5)
+        return [ facet for facet in context['facets'] if facet['name'] == 'subject' ][0]
+
+    def test_expand(self):
+        facet = self.subject_facet('')
+        self.assertEqual((len(facet['values']), facet['more'], facet['expanded']), (5, 25, False))
+        facet = self.subject_facet('expand=subject')
+        self.assertEqual((len(facet['values']), facet['more'], facet['expanded']), (30, 0, True))
+
+
+class DeduplicationTest(SimpleTestCase):
+    def setUp(self):
+        FACET_COUNTS.clear()
+        self.db = disk_database(self)
+        self.db.set_metadata('schema_version', str(SCHEMA_VERSION))
+        # the same text on two sites
+        index_record(self.db, "oai:a:1", title=[ "Mutual Aid" ], creator=[ "Peter Kropotkin" ],
+                     language=[ "en" ], identifier=[ "https://a.example.org/mutual-aid" ])
+        index_record(self.db, "oai:b:1", title=[ "Mutual aid." ], creator=[ "PETER KROPOTKIN" ],
+                     language=[ "eng" ], identifier=[ "https://b.example.org/mutual-aid" ])
+        # different anonymous texts with the same title
+        index_record(self.db, "oai:a:2", title=[ "Poems" ], language=[ "en" ],
+                     identifier=[ "https://a.example.org/poems" ])
+        index_record(self.db, "oai:b:2", title=[ "Poems" ], language=[ "en" ],
+                     identifier=[ "https://b.example.org/poems" ])
+        # an anonymous text on two sites, with the same url
+        index_record(self.db, "oai:a:3", title=[ "Manifesto" ],
+                     identifier=[ "https://c.example.org/manifesto" ])
+        index_record(self.db, "oai:b:3", title=[ "Manifesto" ],
+                     identifier=[ "http://c.example.org/manifesto/" ])
+        self.db.commit()
+        self.readers = MemoryReaders(self.db, self.db_path)
+
+    def cluster(self, identifier):
+        for posting in self.db.postlist("Q" + identifier):
+            return self.db.get_document(posting.docid).get_value(CLUSTER_SLOT)
+
+    def test_record_fingerprint(self):
+        self.assertEqual(record_fingerprint([ "Mutual Aid" ], [ "Peter Kropotkin" ], [ "en" ]),
+                         record_fingerprint([ "mutual aid!" ], [ "PETER KROPOTKIN" ], [ "en" ]))
+        self.assertNotEqual(record_fingerprint([ "Mutual Aid" ], [ "Peter Kropotkin" ], [ "en" ]),
+                            record_fingerprint([ "Mutual Aid" ], [ "Peter Kropotkin" ], [ "it" ]))
+        self.assertIsNone(record_fingerprint([ "Poems" ], [], [ "en" ]))
+        self.assertIsNone(record_fingerprint([ "Poems" ], [ "..." ], [ "en" ]))
+        self.assertIsNone(record_fingerprint([], [ "Peter Kropotkin" ], [ "en" ]))
+
+    def test_assign_cluster(self):
+        self.assertEqual(self.cluster("oai:a:1"), self.cluster("oai:b:1"))
+        self.assertNotEqual(self.cluster("oai:a:2"), self.cluster("oai:b:2"))
+        self.assertEqual(self.cluster("oai:a:3"), self.cluster("oai:b:3"))
+        self.assertNotEqual(self.cluster("oai:a:1"), self.cluster("oai:a:3"))
+        # harvested again: the document keeps its cluster
+        cluster = self.cluster("oai:b:1")
+        index_record(self.db, "oai:b:1", title=[ "Mutual aid." ], creator=[ "PETER KROPOTKIN" ],
+                     language=[ "eng" ], identifier=[ "https://b.example.org/mutual-aid" ])
+        self.assertEqual(self.cluster("oai:b:1"), cluster)
+
+    def api_search(self, collapse):
+        request = RequestFactory().get('/search/api/search', { "page_size": "20" })
+        with override_settings(SEARCH_COLLAPSE=collapse), \
+             mock.patch.object(views, 'SEARCH_READERS', self.readers), \
+             mock.patch.object(views, 'RESULT_CACHE', None):
+            return json.loads(views.api_search(request).content)
+
+    def api_export(self, collapse):
+        request = RequestFactory().get('/search/api/export')
+        with override_settings(SEARCH_COLLAPSE=collapse), \
+             mock.patch.object(views, 'SEARCH_READERS', self.readers):
+            response = views.api_export(request)
+            lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        return [ json.loads(line) for line in lines ]
+
+    def test_collapsed_search(self):
+        collapsed = self.api_search(True)
+        self.assertEqual(collapsed['total'], 4)
+        self.assertEqual(len(collapsed['matches']), 4)
+        also = [ match['also_available'] for match in collapsed['matches'] if match.get('also_available') ]
+        self.assertEqual(sorted(len(copies) for copies in also), [ 1, 1 ])
+        full = self.api_search(False)
+        self.assertEqual(full['total'], 6)
+        self.assertFalse(any(match.get('also_available') for match in full['matches']))
+
+    def test_export_matches_the_search(self):
+        for collapse in (True, False):
+            found = self.api_search(collapse)
+            exported = self.api_export(collapse)
+            self.assertEqual(len(exported), found['total'])
+            self.assertEqual(sorted(record['oai_pmh_identifier'] for record in exported),
+                             sorted(match['oai_pmh_identifier'] for match in found['matches']))
+
+
+class HostSchedulerTest(SimpleTestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(4)
+        self.addCleanup(self.executor.shutdown)
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+
+    def job(self, host, result):
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.running[host])
+        time.sleep(0.02)
+        with self.lock:
+            self.running[host] -= 1
+        return result
+
+    def test_per_host_limit(self):
+        scheduler = HostScheduler(self.executor, per_host=2)
+        futures = [ scheduler.submit('a', self.job, 'a', n) for n in range(8) ]
+        futures.append(scheduler.submit('b', self.job, 'b', 8))
+        self.assertEqual([ future.result(timeout=5) for future in futures ], list(range(9)))
+        self.assertEqual(self.peak, { "a": 2, "b": 1 })
+
+    def test_waiting_jobs_leave_the_threads_to_other_hosts(self):
+        scheduler = HostScheduler(self.executor, per_host=1)
+        other_host_ran = threading.Event()
+        # each job of a waits for the job of b, which can only run if
+        # the queued jobs of a don't hold the threads
+        futures = [ scheduler.submit('a', other_host_ran.wait, 5) for n in range(6) ]
+        scheduler.submit('b', other_host_ran.set).result(timeout=5)
+        self.assertTrue(all(future.result(timeout=5) for future in futures))
+
+    def test_failures_are_returned(self):
+        scheduler = HostScheduler(self.executor, per_host=1)
+        failing = scheduler.submit('a', int, 'not a number')
+        following = scheduler.submit('a', self.job, 'a', 1)
+        self.assertIsInstance(failing.exception(timeout=5), ValueError)
+        self.assertEqual(following.result(timeout=5), 1)
+
+
+class HarvestTest(SimpleTestCase):
+    def setUp(self):
+        self.server, endpoints = start_server(records=250, page_size=50)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.opts = { "url": endpoints[0], "metadataPrefix": "oai_dc" }
+        db = disk_database(self)
+        db.close()
+        repository = self.server.repositories['site-0']
+        self.expected = set("oai:site-0:text-{0}".format(n) for n in range(250)
+                            if not repository.record(n)['deleted'])
+
+    def indexed(self):
+        db = xapian.Database(self.db_path)
+        try:
+            return [ item.term.decode('utf-8')[1:] for item in db.allterms('Q') ]
+        finally:
+            db.close()
+
+    def test_duplicate_jobs(self):
+        done = []
+        results = harvest_sites([ (1, self.opts), (2, dict(self.opts)) ], path=self.db_path,
+                                on_done=lambda key, stats: done.append(key))
+        self.assertEqual(done, [ 1, 2 ])
+        self.assertTrue(results[1]['completed'])
+        self.assertEqual(results[1]['fetched'], 250)
+        self.assertEqual(results[2]['duplicate_of'], 1)
+        self.assertTrue(results[2]['completed'])
+        self.assertEqual(results[2]['fetched'], 0)
+        self.assertEqual(set(self.indexed()), self.expected)
+
+    def test_resume_after_a_failure(self):
+        token_key = resumption_token_key(self.opts['url'], self.opts)
+        commits = []
+        commit = IndexWriter.commit
+
+        def checked_commit(writer):
+            commit(writer)
+            token = writer.db.get_metadata(token_key).decode('utf-8')
+            indexed = set(item.term.decode('utf-8')[1:] for item in writer.db.allterms('Q'))
+            commits.append((token, indexed))
+
+        # the pages from record 150 fail, without retrying
+        self.server.fail_from = 150
+        with mock.patch.object(amwmeta_xapian, 'HARVEST_MAX_RETRIES', 0), \
+             mock.patch.object(IndexWriter, 'commit', checked_commit):
+            results = harvest_sites([ (1, self.opts) ], path=self.db_path, commit_every=20)
+        self.assertFalse(results[1]['completed'])
+        self.assertTrue(results[1]['errors'])
+        self.assertEqual(results[1]['fetched'], 150)
+        self.assertGreater(len(commits), 5)
+        # every commit records the page to start again from: all the
+        # records before it are already in the index
+        for token, indexed in commits:
+            offset = int(token.split('|')[0]) if token else 0
+            self.assertTrue(set(identifier for identifier in self.expected
+                                if int(identifier.rsplit('-', 1)[1]) < offset) <= indexed)
+        token, indexed = commits[-1]
+        self.assertEqual(token, "100|oai_dc|||")
+        self.assertEqual(indexed, set(identifier for identifier in self.expected
+                                      if int(identifier.rsplit('-', 1)[1]) < 150))
+
+        self.server.fail_from = None
+        results = harvest_sites([ (1, self.opts) ], path=self.db_path, commit_every=20)
+        self.assertTrue(results[1]['completed'])
+        # only the pages from the recorded one are fetched again
+        self.assertEqual(results[1]['fetched'], 150)
+        indexed = self.indexed()
+        self.assertEqual(len(indexed), len(set(indexed)))
+        self.assertEqual(set(indexed), self.expected)
+        db = xapian.Database(self.db_path)
+        self.assertEqual(db.get_doccount(), len(self.expected))
+        self.assertEqual(db.get_metadata(token_key), b'')
+        db.close()
+
+
+class FacetCacheTest(SimpleTestCase):
+    def test_older_revision_is_ignored(self):
+        cache = FacetCache()
+        cache.set((1, 5), 'key', { "a": 1 })
+        cache.set((1, 4), 'key', { "a": 2 })
+        self.assertEqual(cache.get((1, 5), 'key'), { "a": 1 })
+        self.assertIsNone(cache.get((1, 4), 'key'))
+        # a new generation starts over
+        cache.set((2, 1), 'key', { "a": 3 })
+        self.assertEqual(cache.get((2, 1), 'key'), { "a": 3 })
+
+    def test_unordered_revisions_replace_the_cache(self):
+        cache = FacetCache()
+        stamp = (1.5, ((10, 100), (11, 200)))
+        cache.set((1, stamp), 'key', { "a": 1 })
+        cache.set((1, None), 'key', { "a": 2 })
+        self.assertEqual(cache.get((1, None), 'key'), { "a": 2 })
+        cache.set((1, 7), 'key', { "a": 3 })
+        self.assertEqual(cache.get((1, 7), 'key'), { "a": 3 })
+        cache.set((1, stamp), 'key', { "a": 4 })
+        self.assertEqual(cache.get((1, stamp), 'key'), { "a": 4 })
+        self.assertIsNone(cache.get((1, 7), 'key'))
+
+
+class MetricsTest(SimpleTestCase):
+    def get(self, **extra):
+        request = RequestFactory().get('/search/metrics', **extra)
+        return views.metrics(request)
+
+    def test_closed_by_default(self):
+        with self.assertRaises(Http404):
+            self.get()
+
+    @override_settings(SEARCH_METRICS_ALLOWED_IPS=[ "10.0.0.5" ])
+    def test_allowed_ips(self):
+        response = self.get(REMOTE_ADDR="10.0.0.5")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"reader_", response.content)
+        with self.assertRaises(Http404):
+            self.get(REMOTE_ADDR="10.0.0.6")
+
+    def test_staff_users(self):
+        request = RequestFactory().get('/search/metrics')
+        request.user = SimpleNamespace(is_active=True, is_staff=True)
+        self.assertEqual(views.metrics(request).status_code, 200)
+        request.user = SimpleNamespace(is_active=True, is_staff=False)
+        with self.assertRaises(Http404):
+            views.metrics(request)
@@ -1,7 +1,24 @@
 from django.urls import path
+from django.conf import settings
 
 from . import views
 
+index = views.index
+api_search = views.api_search
+api_facet = views.api_facet
+api_suggest = views.api_suggest
+if settings.SEARCH_ASYNC:
+    from .offload import offloaded
+    index = offloaded(index)
+    api_search = offloaded(api_search)
+    api_facet = offloaded(api_facet)
+    api_suggest = offloaded(api_suggest)
+
 urlpatterns = [
-    path("", views.index, name="index"),
+    path("", index, name="index"),
+    path("metrics", views.metrics, name="metrics"),
+    path("api/search", api_search, name="api_search"),
+    path("api/export", views.api_export, name="api_export"),
+    path("api/suggest", api_suggest, name="api_suggest"),
+    path("api/facet", api_facet, name="api_facet"),
 ]
@@ -1,22 +1,216 @@
 # -*- coding: utf-8 -*-
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, Http404
 from django.template import loader
 import json
-from amwmeta.xapian import search
+import itertools
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from amwmeta.xapian import (search, export_records, suggest, facet_values, ReaderPool, READERS,
+                            XAPIAN_STUB, XAPIAN_SUGGEST_DB, RECORD_FIELDS, SUGGEST_LIMIT,
+                            SUGGEST_MAX_LIMIT, FACET_PAGE_SIZE, EXPORT_CHUNK_SIZE)
+from amwmeta.metrics import METRICS
 import logging
 from django.urls import reverse
-from amwmeta.utils import paginator
+from django.conf import settings
+from amwmeta.utils import paginator, get_url_with
+from .cache import get_result_cache
 
 logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger(__name__ + '.slow')
 
 # Create your views here.
 
+RESULT_CACHE = get_result_cache()
+
+# with XAPIAN_SHARDS the shards of the sites are searched together
+SEARCH_READERS = ReaderPool(XAPIAN_STUB) if settings.XAPIAN_SHARDS else READERS
+# and their stored suggestions are kept in a database of their own
+SUGGEST_READERS = ReaderPool(XAPIAN_SUGGEST_DB) if settings.XAPIAN_SHARDS else None
+
+def record_timings(request, view, context):
+    timings = context['timings']
+    METRICS.inc('search_requests_total', { "view": view })
+    if context['cache_hit']:
+        METRICS.inc('search_cache_hits_total', { "view": view })
+    for phase in timings.phases:
+        METRICS.observe('search_phase', timings.phases[phase], { "phase": phase })
+    METRICS.observe('search', timings.total(), { "view": view })
+
+    threshold = settings.SLOW_QUERY_THRESHOLD
+    matches = len(context['matches'])
+    if context['pager'] is not None:
+        matches = context['pager'].total_entries
+    if threshold is not None and timings.total() >= threshold:
+        METRICS.inc('search_slow_total', { "view": view })
+        slow_logger.warning("Slow search {0:.3f}s {1} [{2}] matches={3}".format(timings.total(),
+                                                                             request.GET.urlencode(),
+                                                                             timings,
+                                                                             matches))
+
 def index(request):
     template = loader.get_template("search/index.html")
     query_params = request.GET
-    context = search(query_params)
+    context = search(query_params,
+                     facet_sample_size=settings.FACET_SAMPLE_SIZE,
+                     cache=RESULT_CACHE,
+                     readers=SEARCH_READERS,
+                     max_offset=settings.SEARCH_MAX_OFFSET,
+                     collapse=settings.SEARCH_COLLAPSE,
+                     facet_limit=settings.FACET_LIMIT)
+    timings = context['timings']
     logger.debug(context)
     baseurl = reverse('index')
-    context['paginations'] = paginator(context['pager'], baseurl, query_params)
-    return HttpResponse(template.render(context,request))
+    context['paginations'] = paginator(context['pager'], baseurl, query_params, context['max_page'])
+    if context['next_cursor']:
+        context['next_cursor_url'] = get_url_with(baseurl, query_params,
+                                                  { "after": context['next_cursor'] })
+    # the facets are expanded in the page, search/api/facet is for the
+    # API clients
+    facets = []
+    for facet in context['facets']:
+        if facet['expanded']:
+            facet = dict(facet, less_url=get_url_with(baseurl, query_params, { "expand": None }))
+        elif facet['more']:
+            facet = dict(facet, more_url=get_url_with(baseurl, query_params, { "expand": facet['name'] }))
+        facets.append(facet)
+    context['facets'] = facets
+    histogram = context.get('date_histogram')
+    if histogram:
+        # search() results can be shared through the cache: link copies
+        context['date_histogram'] = dict(histogram, buckets=[
+            dict(bucket, url=get_url_with(baseurl, query_params,
+                                          { "date_from": bucket['from'], "date_to": bucket['to'] }))
+            for bucket in histogram['buckets']
+        ])
+        if context['date_from'] is not None or context['date_to'] is not None:
+            context['date_histogram_clear'] = get_url_with(baseurl, query_params,
+                                                           { "date_from": None, "date_to": None })
+    response = HttpResponse(template.render(context,request))
+    timings.mark('render')
+    record_timings(request, 'index', context)
+    if settings.SEARCH_SERVER_TIMING:
+        response['Server-Timing'] = timings.server_timing()
+    return response
+
+def requested_fields(query_params):
+    """The record fields listed in the fields parameter (comma separated
+    or repeated), all of them by default"""
+    fields = []
+    for value in query_params.getlist('fields'):
+        fields.extend(f.strip() for f in value.split(',') if f.strip() in RECORD_FIELDS)
+    return fields or RECORD_FIELDS
+
+def select_fields(record, fields):
+    return { field: record[field] for field in fields if field in record }
+
+def api_search(request):
+    query_params = request.GET
+    try:
+        for param in ('page_number', 'page_size'):
+            if param in query_params:
+                int(query_params[param])
+    except ValueError:
+        return JsonResponse({ "error": "page_number and page_size must be numbers" }, status=400)
+    context = search(query_params,
+                     facet_sample_size=settings.FACET_SAMPLE_SIZE,
+                     cache=RESULT_CACHE,
+                     readers=SEARCH_READERS,
+                     max_offset=settings.SEARCH_MAX_OFFSET,
+                     collapse=settings.SEARCH_COLLAPSE,
+                     facet_limit=settings.FACET_LIMIT)
+    fields = requested_fields(query_params)
+    pager = context['pager']
+    out = {
+        "query": context['querystring'],
+        "sort": context['sort'],
+        "date_from": context['date_from'],
+        "date_to": context['date_to'],
+        "filters": context['filters'],
+        "facets": context['facets'],
+        "facets_approximate": context['facets_approximate'],
+        "date_histogram": context['date_histogram'],
+        "next_cursor": context['next_cursor'],
+        "matches": [ select_fields(record, fields) for record in context['matches'] ],
+    }
+    if pager is not None:
+        out['total'] = pager.total_entries
+        out['page_number'] = pager.current_page
+        out['page_size'] = pager.entries_per_page
+        out['last_page'] = pager.last_page()
+        out['max_page'] = context['max_page']
+    response = JsonResponse(out)
+    context['timings'].mark('render')
+    record_timings(request, 'api_search', context)
+    return response
+
+def export_lines(records, fields, size):
+    """The next size records, as lines of JSON"""
+    return "".join(json.dumps(select_fields(record, fields)) + "\n"
+                   for record in itertools.islice(records, size))
+
+async def aexport_chunks(records, fields):
+    # every chunk is fetched in a thread, so the event loop is never
+    # blocked and only one chunk at a time is in memory
+    fetch = sync_to_async(export_lines, thread_sensitive=False)
+    while True:
+        chunk = await fetch(records, fields, EXPORT_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+def api_export(request):
+    """All the matches, one JSON record per line"""
+    query_params = request.GET
+    fields = requested_fields(query_params)
+    records = export_records(query_params, path=SEARCH_READERS.path,
+                             collapse=settings.SEARCH_COLLAPSE)
+    METRICS.inc('search_requests_total', { "view": "api_export" })
+    # under ASGI a synchronous iterator would be consumed into a list
+    # before sending anything
+    if isinstance(request, ASGIRequest):
+        return StreamingHttpResponse(aexport_chunks(records, fields),
+                                     content_type="application/x-ndjson")
+    lines = (json.dumps(select_fields(record, fields)) + "\n" for record in records)
+    return StreamingHttpResponse(lines, content_type="application/x-ndjson")
+
+def api_suggest(request):
+    """Most common titles, creators or subjects starting with q"""
+    field = request.GET.get('field', 'title')
+    try:
+        limit = min(max(int(request.GET.get('limit', SUGGEST_LIMIT)), 1), SUGGEST_MAX_LIMIT)
+    except ValueError:
+        limit = SUGGEST_LIMIT
+    suggestions = suggest(field, request.GET.get('q'), limit=limit, readers=SEARCH_READERS,
+                          precomputed=SUGGEST_READERS)
+    METRICS.inc('search_requests_total', { "view": "api_suggest" })
+    return JsonResponse({ "field": field, "suggestions": suggestions })
+
+def api_facet(request):
+    """Page through the values of a facet (field) for the search, or
+    filter them by the text in facet_query"""
+    query_params = request.GET
+    try:
+        offset = max(int(query_params.get('offset', 0)), 0)
+        limit = min(max(int(query_params.get('limit', FACET_PAGE_SIZE)), 1), 500)
+    except ValueError:
+        return JsonResponse({ "error": "offset and limit must be numbers" }, status=400)
+    out = facet_values(query_params, query_params.get('field'),
+                       contains=query_params.get('facet_query'),
+                       offset=offset, limit=limit,
+                       facet_sample_size=settings.FACET_SAMPLE_SIZE,
+                       readers=SEARCH_READERS,
+                       collapse=settings.SEARCH_COLLAPSE)
+    METRICS.inc('search_requests_total', { "view": "api_facet" })
+    if out is None:
+        return JsonResponse({ "error": "unknown facet" }, status=400)
+    return JsonResponse(out)
+
+def metrics(request):
+    user = getattr(request, 'user', None)
+    if not (user is not None and user.is_active and user.is_staff) \
+       and request.META.get('REMOTE_ADDR') not in settings.SEARCH_METRICS_ALLOWED_IPS:
+        raise Http404("Not found")
+    readers = { "reader_" + name + "_total": value for name, value in SEARCH_READERS.stats().items() }
+    return HttpResponse(METRICS.render(readers),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")